@@ -4,8 +4,33 @@
 # Python script to copy all rows from one table to another
 
 import sys, argparse, os
+import json, base64, threading, hashlib, time
+import importlib
+from collections import deque
+from decimal import Decimal
 import boto3
+from boto3.dynamodb.types import Binary
 from botocore.exceptions import ClientError
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, Future, as_completed, wait, FIRST_COMPLETED
+import ddb_common
+
+# Set when the user hits Ctrl-C so segments stop after flushing their current page
+stop_copy = threading.Event()
+
+# Stream records this much older than the start of the bulk copy are already in the scan
+STREAM_CLOCK_SKEW = 60
+STREAM_POLL_SECONDS = 5
+# GetRecords can return empty pages before reaching a shard's records, so an open shard only counts
+# as caught up after this many empty pages in a row
+STREAM_EMPTY_PAGES = 10
+# Pages a shard gets before its thread moves on to another shard, so busy shards can't starve the rest
+STREAM_PAGES_PER_TURN = 100
+
+# Pages each segment can have waiting in the transform pool before it blocks on the oldest
+TRANSFORM_PAGES_IN_FLIGHT = 2
+
+# Set in each transform worker process by load_transform()
+transform_function = None
 
 def do_args():
     parser = argparse.ArgumentParser()
@@ -15,38 +40,570 @@ def do_args():
     # parser.add_argument("--key_attribute", help="primary key")
     parser.add_argument("--dest-profile", help="Use this AWS Profile to write to the destination table (if in a different account)")
     parser.add_argument("--dest-region", help="Use this AWS Profile to write to the destination table (if in a different account)", default=os.environ['AWS_DEFAULT_REGION'])
+    parser.add_argument("--segments", help="Split the scan of the source table into this many parallel scan segments, or auto to size it from the table", type=ddb_common.segments_arg, default=1)
+    parser.add_argument("--workers", help="Number of segments to copy at the same time (defaults to --segments, at most 32)", type=int)
+    parser.add_argument("--checkpoint", help="Record each segment's progress in this file so an interrupted copy can be resumed")
+    parser.add_argument("--resume", help="Pick up from the progress recorded in --checkpoint", action='store_true')
+    parser.add_argument("--raw", help="Copy DynamoDB's wire format straight through instead of converting items to Python types", action='store_true')
+    parser.add_argument("--capacity-fraction", help="Limit reads and writes to this fraction (0-1] of each table's provisioned capacity", type=float)
+    parser.add_argument("--transform", help="Pass every item through function in module (module:function) before it is written. "
+                        "It gets one item and returns the item to write or None to drop it", metavar='MODULE:FUNCTION')
+    parser.add_argument("--transform-workers", help="Number of processes running --transform (defaults to the number of CPUs)", type=int)
+    parser.add_argument("--follow", help="Record the source table's stream position before the copy, then apply the changes made during the copy until caught up", action='store_true')
+    parser.add_argument("--keep-following", help="With --follow, keep applying changes until interrupted", action='store_true')
+    parser.add_argument("--endpoint-url", help="DynamoDB endpoint for both tables, e.g. http://localhost:8000 for DynamoDB Local")
+    parser.add_argument("--verify", help="After the copy, compare the destination with the source and report missing, extra and different keys", action='store_true')
+    parser.add_argument("--verify-only", help="Only compare the tables, don't copy anything", action='store_true')
+    parser.add_argument("--verify-buckets", help="Number of key buckets the verify digests are kept in", type=int, default=4096)
+    parser.add_argument("--verify-max-buckets", help="Only compare items key by key when at most this many buckets differ, "
+                        "past that just report the buckets (the comparison holds every key in them in memory)", type=int, default=64)
 
     args = parser.parse_args()
 
+    if args.resume and not args.checkpoint:
+        print("--resume requires --checkpoint")
+        exit(1)
+
+    if args.capacity_fraction is not None and not 0 < args.capacity_fraction <= 1:
+        print("--capacity-fraction must be greater than 0 and at most 1")
+        exit(1)
+    if args.keep_following:
+        args.follow = True
+    if args.follow and args.verify_only:
+        print("--follow can't be used with --verify-only")
+        exit(1)
+    if args.transform:
+        if args.follow or args.verify or args.verify_only:
+            print("--transform can't be used with --follow or --verify")
+            exit(1)
+        # Fail now rather than in every worker process
+        load_transform(args.transform)
+    if args.workers is not None and args.workers < 1:
+        print("--workers must be at least 1")
+        exit(1)
+
     return(args)
 
-def main(args):
-    # Connect to the table.
-    dynamodb = boto3.resource('dynamodb')
-    src_table = dynamodb.Table(args.source)
+def encode_key(key, raw):
+    # Key attributes can only be strings, numbers or binary
+    output = {}
+    for name, value in key.items():
+        if raw:
+            if 'B' in value:
+                output[name] = {'B': base64.b64encode(value['B']).decode('ascii')}
+            else:
+                output[name] = value
+        elif isinstance(value, Decimal):
+            output[name] = {'N': str(value)}
+        elif isinstance(value, Binary):
+            output[name] = {'B': base64.b64encode(value.value).decode('ascii')}
+        else:
+            output[name] = {'S': value}
+    return(output)
+
+def decode_key(key, raw):
+    output = {}
+    for name, value in key.items():
+        if raw:
+            if 'B' in value:
+                output[name] = {'B': base64.b64decode(value['B'])}
+            else:
+                output[name] = value
+        elif 'N' in value:
+            output[name] = Decimal(value['N'])
+        elif 'B' in value:
+            output[name] = Binary(base64.b64decode(value['B']))
+        else:
+            output[name] = value['S']
+    return(output)
+
+class Checkpoint(object):
+    """Progress of each scan segment and stream shard, saved after every page of writes is flushed.
+
+    With no filename the progress is only kept in memory.
+    """
+
+    def __init__(self, filename, args):
+        self.filename = filename
+        self.raw = args.raw
+        self.lock = threading.Lock()
+        self.state = {
+            'source': args.source,
+            'dest': args.dest,
+            'segments': args.segments,
+            'progress': {str(s): {'LastEvaluatedKey': None, 'count': 0, 'done': False} for s in range(args.segments)}
+        }
+
+    @classmethod
+    def load(cls, filename, args):
+        with open(filename) as f:
+            state = json.load(f)
+        if state['source'] != args.source or state['dest'] != args.dest:
+            print(f"Checkpoint {filename} is for a copy from {state['source']} to {state['dest']}")
+            exit(1)
+        if state['segments'] != args.segments:
+            print(f"Checkpoint {filename} was written with --segments {state['segments']}, using that")
+            args.segments = state['segments']
+        checkpoint = cls(filename, args)
+        checkpoint.state = state
+        return(checkpoint)
+
+    def get(self, segment):
+        progress = self.state['progress'][str(segment)]
+        start_key = None
+        if progress['LastEvaluatedKey'] is not None:
+            start_key = decode_key(progress['LastEvaluatedKey'], self.raw)
+        return(start_key, progress['count'], progress['done'])
+
+    def update(self, segment, last_key, count):
+        with self.lock:
+            self.state['progress'][str(segment)] = {
+                'LastEvaluatedKey': encode_key(last_key, self.raw) if last_key else None,
+                'count': count,
+                'done': last_key is None
+            }
+            self.save()
 
-    dest_region = args.dest_region
+    def update_stream(self, shard_id, sequence_number, done=False):
+        with self.lock:
+            self.state['stream']['shards'][shard_id] = {'SequenceNumber': sequence_number, 'done': done}
+            self.save()
 
+    def save(self):
+        if self.filename is None:
+            return
+        # Write to a temp file and rename so a crash never leaves a half written checkpoint
+        tmp_file = f"{self.filename}.tmp"
+        with open(tmp_file, 'w') as f:
+            json.dump(self.state, f, indent=2)
+        os.replace(tmp_file, self.filename)
+
+def get_client(session, args, raw=None):
+    if raw or (raw is None and args.raw):
+        return(session.client('dynamodb', endpoint_url=args.endpoint_url))
+    # The resource's client converts items to and from Python types (Decimal, set, Binary)
+    return(session.resource('dynamodb', endpoint_url=args.endpoint_url).meta.client)
+
+def get_dest_session(args):
     if args.dest_profile:
-        dest_session = boto3.Session(profile_name=args.dest_profile, region_name=dest_region)
-    else:
-        dest_session = boto3.Session(region_name=dest_region)
+        return(boto3.Session(profile_name=args.dest_profile, region_name=args.dest_region))
+    return(boto3.Session(region_name=args.dest_region))
+
+def get_src_client(args):
+    # boto3 sessions are not thread safe, so every segment builds its own
+    return(get_client(boto3.Session(), args))
+
+def get_dest_client(args):
+    return(get_client(get_dest_session(args), args))
+
+def load_transform(spec):
+    global transform_function
+    if ':' not in spec:
+        print("--transform must look like module:function")
+        exit(1)
+    module_name, function_name = spec.split(':', 1)
+    # Let people keep their transform module next to where they run the copy
+    if os.getcwd() not in sys.path:
+        sys.path.insert(0, os.getcwd())
+    transform_function = getattr(importlib.import_module(module_name), function_name)
+
+def transform_page(items):
+    # Runs in a transform worker process
+    output = []
+    for item in items:
+        item = transform_function(item)
+        if item is not None:
+            output.append(item)
+    return(output)
+
+def write_page(args, segment, pending, checkpoint, dest_client, write_throttle):
+    items, start_key, count = pending
+    if isinstance(items, Future):
+        items = items.result()
+    # batch_write returns once the whole page is written, so the checkpoint never gets ahead of the writes
+    requests = [{'PutRequest': {'Item': item}} for item in items]
+    ddb_common.batch_write(dest_client, args.dest, requests, write_throttle)
+    checkpoint.update(segment, start_key, count)
+    if args.debug:
+        print(f"Segment {segment}: copied {count} items")
+
+def copy_segment(args, segment, checkpoint, read_throttle, write_throttle, transform_pool):
+    start_key, count, done = checkpoint.get(segment)
+    if done:
+        return(count)
+
+    src_client = get_src_client(args)
+    dest_client = get_dest_client(args)
+
+    scan_args = {'TableName': args.source}
+    if args.segments > 1:
+        scan_args['Segment'] = segment
+        scan_args['TotalSegments'] = args.segments
+
+    # Pages are written strictly in scan order, so the checkpoint stays correct with transforms running ahead
+    pending = deque()
+    while not stop_copy.is_set():
+        if start_key:
+            response = ddb_common.read_page(src_client.scan, read_throttle, ExclusiveStartKey=start_key, **scan_args)
+        else:
+            response = ddb_common.read_page(src_client.scan, read_throttle, **scan_args)
+        count += len(response['Items'])
+        start_key = response.get('LastEvaluatedKey')
+        if transform_pool:
+            pending.append((transform_pool.submit(transform_page, response['Items']), start_key, count))
+        else:
+            pending.append((response['Items'], start_key, count))
+        while len(pending) > (TRANSFORM_PAGES_IN_FLIGHT if transform_pool else 0):
+            write_page(args, segment, pending.popleft(), checkpoint, dest_client, write_throttle)
+        if start_key is None:
+            break
+    while pending:
+        write_page(args, segment, pending.popleft(), checkpoint, dest_client, write_throttle)
+    return(count)
+
+def copy_table(args, checkpoint):
+    read_throttle = ddb_common.make_throttles(get_src_client(args), args.source, args.capacity_fraction)[0]
+    write_throttle = ddb_common.make_throttles(get_dest_client(args), args.dest, args.capacity_fraction)[1]
+
+    transform_pool = None
+    if args.transform:
+        transform_pool = ProcessPoolExecutor(max_workers=args.transform_workers, initializer=load_transform, initargs=(args.transform,))
+        # Start the worker processes now, before the segment threads exist
+        transform_pool.submit(int).result()
 
-    dest_dynamodb = dest_session.resource('dynamodb')
-    dest_table = dest_dynamodb.Table(args.dest)
+    total = 0
+    executor = ThreadPoolExecutor(max_workers=args.workers)
+    try:
+        futures = {executor.submit(copy_segment, args, segment, checkpoint, read_throttle, write_throttle, transform_pool): segment for segment in range(args.segments)}
+        for future in as_completed(futures):
+            count = future.result()
+            total += count
+            print(f"Segment {futures[future]} of {args.segments} finished: {count} items")
+    except BaseException:
+        # Ctrl-C or a failed segment, let the other segments flush their current page and stop
+        print("Stopping, waiting for in-flight pages to be written")
+        stop_copy.set()
+        executor.shutdown(wait=True, cancel_futures=True)
+        if args.checkpoint:
+            print(f"Progress saved to {args.checkpoint}, re-run with --resume to continue")
+        raise
+    finally:
+        if transform_pool:
+            transform_pool.shutdown()
+    executor.shutdown()
+    print(f"Copied {total} items from {args.source} to {args.dest}")
+    print(read_throttle.summary())
+    print(write_throttle.summary())
+
+def canonical(value):
+    """An AttributeValue with set members in a fixed order, so equal items hash the same"""
+    (dtype, data), = value.items()
+    if dtype == 'M':
+        return({'M': {k: canonical(v) for k, v in data.items()}})
+    if dtype == 'L':
+        return({'L': [canonical(v) for v in data]})
+    if dtype == 'NS':
+        return({'NS': sorted(data, key=Decimal)})
+    if dtype in ('SS', 'BS'):
+        return({dtype: sorted(data)})
+    return(value)
+
+def item_digest(item, key_names, buckets):
+    """Return (bucket, key, sha256) for an item in wire format"""
+    key = json.dumps({k: item[k] for k in key_names}, sort_keys=True, default=ddb_common.encode_bytes)
+    body = json.dumps({k: canonical(v) for k, v in item.items()}, sort_keys=True, separators=(',', ':'), default=ddb_common.encode_bytes)
+    bucket = int.from_bytes(hashlib.sha256(key.encode()).digest()[:8], 'big') % buckets
+    return(bucket, key, hashlib.sha256(body.encode()).digest())
+
+def scan_digests(args, get_session, table_name, segment, key_names, throttle, wanted):
+    """Digest one segment of a table.
 
-    batch = dest_table.batch_writer()
-    response = src_table.scan()
-    while 'LastEvaluatedKey' in response :
+    With wanted=None return the XOR of the item hashes and the item count per bucket,
+    otherwise return {key: hash} for the items in the wanted buckets.
+    """
+    client = get_client(get_session(args), args, raw=True)
+    scan_args = {'TableName': table_name}
+    if args.segments > 1:
+        scan_args['Segment'] = segment
+        scan_args['TotalSegments'] = args.segments
+
+    digests = [[0, 0] for b in range(args.verify_buckets)] if wanted is None else {}
+    response = ddb_common.read_page(client.scan, throttle, **scan_args)
+    while True:
         for item in response['Items']:
-            print(".")
-            batch.put_item(Item=item)
-        response = src_table.scan(ExclusiveStartKey=response['LastEvaluatedKey'])
-    for item in response['Items']:
-        print(".")
-        batch.put_item(Item=item)
-    # FIXME - make sure all entries are written
-    batch.__exit__(None, None, None)
+            bucket, key, digest = item_digest(item, key_names, args.verify_buckets)
+            if wanted is None:
+                # XOR doesn't care about the order items arrive in
+                digests[bucket][0] ^= int.from_bytes(digest, 'big')
+                digests[bucket][1] += 1
+            elif bucket in wanted:
+                digests[key] = digest
+        if 'LastEvaluatedKey' not in response:
+            break
+        response = ddb_common.read_page(client.scan, throttle, ExclusiveStartKey=response['LastEvaluatedKey'], **scan_args)
+    return(digests)
+
+def digest_table(args, get_session, table_name, key_names, throttle, wanted=None):
+    with ThreadPoolExecutor(max_workers=args.workers) as executor:
+        futures = [executor.submit(scan_digests, args, get_session, table_name, segment, key_names, throttle, wanted) for segment in range(args.segments)]
+        results = [future.result() for future in futures]
+    if wanted is not None:
+        output = {}
+        for result in results:
+            output.update(result)
+        return(output)
+    buckets = [[0, 0] for b in range(args.verify_buckets)]
+    for result in results:
+        for b, (digest, count) in enumerate(result):
+            buckets[b][0] ^= digest
+            buckets[b][1] += count
+    return(buckets)
+
+def merkle_root(buckets):
+    root = hashlib.sha256()
+    for digest, count in buckets:
+        root.update(digest.to_bytes(32, 'big') + count.to_bytes(8, 'big'))
+    return(root.hexdigest())
+
+def verify_tables(args):
+    """Compare the two tables bucket by bucket, then item by item in the buckets that differ"""
+    table = get_src_client(args).describe_table(TableName=args.source)['Table']
+    key_names = [k['AttributeName'] for k in table['KeySchema']]
+    src_throttle = ddb_common.make_throttles(get_src_client(args), args.source, args.capacity_fraction)[0]
+    dest_throttle = ddb_common.make_throttles(get_dest_client(args), args.dest, args.capacity_fraction)[0]
+
+    src_buckets = digest_table(args, lambda args: boto3.Session(), args.source, key_names, src_throttle)
+    dest_buckets = digest_table(args, get_dest_session, args.dest, key_names, dest_throttle)
+    print(f"{args.source}: {sum(c for d, c in src_buckets)} items, digest {merkle_root(src_buckets)}")
+    print(f"{args.dest}: {sum(c for d, c in dest_buckets)} items, digest {merkle_root(dest_buckets)}")
+
+    wanted = set(b for b in range(args.verify_buckets) if src_buckets[b] != dest_buckets[b])
+    if not wanted:
+        print(f"{args.dest} matches {args.source}")
+        return(True)
+
+    if len(wanted) > args.verify_max_buckets:
+        # Most of the key space differs, e.g. a half copied destination. Listing the keys would hold them all in memory
+        src_count = sum(src_buckets[b][1] for b in wanted)
+        dest_count = sum(dest_buckets[b][1] for b in wanted)
+        print(f"{len(wanted)} of {args.verify_buckets} buckets differ (more than --verify-max-buckets {args.verify_max_buckets}), "
+              f"they hold {src_count} items in {args.source} and {dest_count} in {args.dest}")
+        for b in sorted(wanted) if args.debug else sorted(wanted)[:20]:
+            print(f"    bucket {b}: {src_buckets[b][1]} items in {args.source}, {dest_buckets[b][1]} in {args.dest}")
+        if len(wanted) > 20 and not args.debug:
+            print(f"    ... and {len(wanted) - 20} more (use --debug to list them all)")
+        return(False)
+
+    print(f"{len(wanted)} of {args.verify_buckets} buckets differ, comparing their items")
+    src_items = digest_table(args, lambda args: boto3.Session(), args.source, key_names, src_throttle, wanted)
+    dest_items = digest_table(args, get_dest_session, args.dest, key_names, dest_throttle, wanted)
+    missing = sorted(k for k in src_items if k not in dest_items)
+    extra = sorted(k for k in dest_items if k not in src_items)
+    different = sorted(k for k in src_items if k in dest_items and src_items[k] != dest_items[k])
+    for label, keys in (('Missing from', missing), ('Extra in', extra), ('Different in', different)):
+        print(f"{label} {args.dest}: {len(keys)} items")
+        for key in keys if args.debug else keys[:20]:
+            print(f"    {key}")
+        if len(keys) > 20 and not args.debug:
+            print(f"    ... and {len(keys) - 20} more (use --debug to list them all)")
+    return(False)
+
+def get_streams_client(args):
+    return(boto3.Session().client('dynamodbstreams', endpoint_url=args.endpoint_url))
+
+def list_shards(streams, stream_arn):
+    shards = []
+    response = streams.describe_stream(StreamArn=stream_arn)['StreamDescription']
+    shards += response['Shards']
+    while 'LastEvaluatedShardId' in response:
+        response = streams.describe_stream(StreamArn=stream_arn, ExclusiveStartShardId=response['LastEvaluatedShardId'])['StreamDescription']
+        shards += response['Shards']
+    return(shards)
+
+def record_stream_position(args, checkpoint):
+    """Remember the source's stream and the time the bulk copy started, before the scan begins"""
+    if 'stream' in checkpoint.state:
+        # Resuming, the position from the original run still applies
+        return
+    table = get_src_client(args).describe_table(TableName=args.source)['Table']
+    view_type = table.get('StreamSpecification', {}).get('StreamViewType')
+    if view_type not in ('NEW_IMAGE', 'NEW_AND_OLD_IMAGES'):
+        print(f"--follow needs a stream with NEW_IMAGE or NEW_AND_OLD_IMAGES enabled on {args.source}")
+        exit(1)
+    if any(progress['count'] for progress in checkpoint.state['progress'].values()):
+        print("Warning: the copy being resumed wasn't started with --follow, changes made before this run may be missed")
+    stream_arn = table['LatestStreamArn']
+    checkpoint.state['stream'] = {
+        'StreamArn': stream_arn,
+        'started': time.time(),
+        'shards': {}
+    }
+    checkpoint.save()
+    print(f"Following {stream_arn} from {len(list_shards(get_streams_client(args), stream_arn))} shards")
+
+def apply_records(args, dest_client, records, started, throttle):
+    # Only the last change to each key in a page matters, and BatchWriteItem refuses duplicate keys
+    latest = {}
+    for record in records:
+        if record['dynamodb']['ApproximateCreationDateTime'].timestamp() < started - STREAM_CLOCK_SKEW:
+            continue
+        key = json.dumps(record['dynamodb']['Keys'], sort_keys=True, default=ddb_common.encode_bytes)
+        latest.pop(key, None)
+        latest[key] = record
+    requests = []
+    for record in latest.values():
+        if record['eventName'] == 'REMOVE':
+            requests.append({'DeleteRequest': {'Key': record['dynamodb']['Keys']}})
+        else:
+            requests.append({'PutRequest': {'Item': record['dynamodb']['NewImage']}})
+    ddb_common.batch_write(dest_client, args.dest, requests, throttle)
+    return(len(requests))
+
+def shard_iterator(streams, stream, shard_id):
+    """An iterator just past the checkpoint's last applied record in the shard, or at its start"""
+    sequence_number = stream['shards'].get(shard_id, {}).get('SequenceNumber')
+    if sequence_number:
+        return(streams.get_shard_iterator(StreamArn=stream['StreamArn'], ShardId=shard_id,
+            ShardIteratorType='AFTER_SEQUENCE_NUMBER', SequenceNumber=sequence_number)['ShardIterator'])
+    return(streams.get_shard_iterator(StreamArn=stream['StreamArn'], ShardId=shard_id, ShardIteratorType='TRIM_HORIZON')['ShardIterator'])
+
+def follow_shard(args, checkpoint, shard_id, closed, throttle, iterators):
+    """Apply a turn's worth of one shard's records in order.
+
+    Returns 'done' once a closed shard is finished, 'caught-up' after STREAM_EMPTY_PAGES empty
+    pages in a row on an open shard, or 'more' when the turn ran out first. A closed shard is read
+    until it ends however many empty pages it has. iterators keeps each shard's position between turns.
+    """
+    streams = get_streams_client(args)
+    dest_client = get_client(get_dest_session(args), args, raw=True)
+    stream = checkpoint.state['stream']
+    sequence_number = stream['shards'].get(shard_id, {}).get('SequenceNumber')
+    iterator = iterators.get(shard_id) or shard_iterator(streams, stream, shard_id)
+
+    count = 0
+    empty_pages = 0
+    status = 'more'
+    for page in range(STREAM_PAGES_PER_TURN):
+        if stop_copy.is_set():
+            break
+        try:
+            response = streams.get_records(ShardIterator=iterator, Limit=1000)
+        except ClientError as e:
+            if e.response['Error']['Code'] != 'ExpiredIteratorException':
+                raise
+            # Iterators only last 15 minutes, start again from the checkpoint
+            iterator = shard_iterator(streams, stream, shard_id)
+            continue
+        records = response['Records']
+        if records:
+            count += apply_records(args, dest_client, records, stream['started'], throttle)
+            sequence_number = records[-1]['dynamodb']['SequenceNumber']
+        iterator = response.get('NextShardIterator')
+        checkpoint.update_stream(shard_id, sequence_number, done=iterator is None)
+        if iterator is None:
+            status = 'done'
+            break
+        empty_pages = 0 if records else empty_pages + 1
+        if not closed and empty_pages >= STREAM_EMPTY_PAGES:
+            status = 'caught-up'
+            break
+    iterators[shard_id] = iterator
+    if args.debug:
+        print(f"Shard {shard_id}: applied {count} changes, {status}")
+    return(status)
+
+def ready_shards(args, shards, finished, caught_up, running):
+    """The shards that can be given a turn now"""
+    known = set(shard['ShardId'] for shard in shards)
+    ready = []
+    for shard in shards:
+        shard_id = shard['ShardId']
+        if shard_id in finished or shard_id in running:
+            continue
+        if shard_id in caught_up:
+            if args.keep_following:
+                if time.monotonic() - caught_up[shard_id] < STREAM_POLL_SECONDS:
+                    continue
+            elif 'EndingSequenceNumber' not in shard['SequenceNumberRange']:
+                # Still open, it's caught up for this run. If it has closed since, read the rest of it
+                continue
+        # A key's changes move from the parent shard to its children, so the parent has to go first
+        parent = shard.get('ParentShardId')
+        if parent in known and parent not in finished:
+            continue
+        ready.append(shard)
+    return(ready)
+
+def follow_stream(args, checkpoint):
+    """Apply the source's stream to the destination, taking turns on every shard whose parent is finished"""
+    stream = checkpoint.state['stream']
+    if time.time() - stream['started'] > 24 * 3600:
+        print("Warning: the copy started more than 24 hours ago, some stream records have already been trimmed")
+    streams = get_streams_client(args)
+    throttle = ddb_common.make_throttles(get_dest_client(args), args.dest, args.capacity_fraction)[1]
+
+    finished = set(shard_id for shard_id, shard in stream['shards'].items() if shard['done'])
+    # Open shards that were caught up, and when. With --keep-following they're read again after STREAM_POLL_SECONDS
+    caught_up = {}
+    iterators = {}
+    running = {}
+    shards = []
+    listed = None
+    executor = ThreadPoolExecutor(max_workers=args.workers)
+    try:
+        while not stop_copy.is_set():
+            if listed is None or time.monotonic() - listed >= STREAM_POLL_SECONDS:
+                shards = list_shards(streams, stream['StreamArn'])
+                listed = time.monotonic()
+            ready = ready_shards(args, shards, finished, caught_up, running)
+            if not ready and not running and not args.keep_following:
+                # Shards may have closed or split since the last listing, check once more before stopping
+                shards = list_shards(streams, stream['StreamArn'])
+                listed = time.monotonic()
+                ready = ready_shards(args, shards, finished, caught_up, running)
+                if not ready:
+                    break
+            for shard in ready:
+                closed = 'EndingSequenceNumber' in shard['SequenceNumberRange']
+                running[shard['ShardId']] = executor.submit(follow_shard, args, checkpoint, shard['ShardId'], closed, throttle, iterators)
+            if not running:
+                time.sleep(1)
+                continue
+            completed, pending = wait(running.values(), timeout=STREAM_POLL_SECONDS, return_when=FIRST_COMPLETED)
+            for shard_id, future in list(running.items()):
+                if future in completed:
+                    del running[shard_id]
+                    status = future.result()
+                    if status == 'done':
+                        finished.add(shard_id)
+                    elif status == 'caught-up':
+                        caught_up[shard_id] = time.monotonic()
+                    else:
+                        caught_up.pop(shard_id, None)
+    except BaseException:
+        stop_copy.set()
+        executor.shutdown(wait=True, cancel_futures=True)
+        raise
+    executor.shutdown()
+    print(f"Caught up with the changes to {args.source}")
+    print(throttle.summary())
+
+def main(args):
+    ddb_common.resolve_segments(args, get_src_client(args), args.source)
+    if args.resume:
+        checkpoint = Checkpoint.load(args.checkpoint, args)
+    else:
+        checkpoint = Checkpoint(args.checkpoint, args)
+
+    if args.follow:
+        record_stream_position(args, checkpoint)
+    if not args.verify_only:
+        copy_table(args, checkpoint)
+    if args.follow:
+        follow_stream(args, checkpoint)
+    if args.verify or args.verify_only:
+        if not verify_tables(args):
+            exit(1)
 
 if __name__ == '__main__':
     try:
@@ -54,4 +611,4 @@ if __name__ == '__main__':
         main(args)
         exit(0)
     except KeyboardInterrupt:
-        exit(1)
\ No newline at end of file
+        exit(1)
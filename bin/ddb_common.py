@@ -0,0 +1,221 @@
+# Helpers shared by the DynamoDB copy, export and purge scripts.
+# Not a script itself, the scripts import it from the bin directory.
+
+import time, random, threading, math
+import argparse
+import base64
+from decimal import Decimal
+from boto3.dynamodb.types import TypeSerializer
+from boto3.dynamodb.conditions import ConditionExpressionBuilder
+from botocore.exceptions import ClientError
+
+THROTTLE_ERRORS = ('ProvisionedThroughputExceededException', 'ThrottlingException', 'RequestLimitExceeded')
+BATCH_WRITE_SIZE = 25  # BatchWriteItem limit
+MAX_RETRIES = 12
+GB_PER_SEGMENT = 2  # AWS's suggested starting point for parallel scans
+MAX_SUGGESTED_SEGMENTS = 100
+MAX_DEFAULT_WORKERS = 32  # Each worker has its own session and clients, more takes an explicit --workers
+
+
+class CapacityThrottle(object):
+    """Pace requests so the consumed capacity stays near a target units/sec.
+
+    The rate is halved every time DynamoDB throttles a request and climbs back
+    towards the target after each successful one. With no target (on-demand
+    tables, or no --capacity-fraction) it only keeps the statistics.
+    """
+
+    def __init__(self, name, target=None):
+        self.name = name
+        self.target = target
+        self.rate = target
+        self.lock = threading.Lock()
+        self.started = time.monotonic()
+        self.next_request = self.started
+        self.units = 0.0
+        self.items = 0
+        self.throttles = 0
+
+    def consume(self, units, items=0):
+        """Record a finished request and sleep until the capacity it used has been paid for"""
+        with self.lock:
+            self.units += units
+            self.items += items
+            if self.target is None:
+                return
+            self.rate = min(self.target, self.rate + self.target * 0.05)
+            now = time.monotonic()
+            self.next_request = max(self.next_request, now) + units / self.rate
+            delay = self.next_request - now
+        if delay > 0:
+            time.sleep(delay)
+
+    def throttled(self, attempt):
+        """Record a throttled request, slow down and back off before the retry"""
+        with self.lock:
+            self.throttles += 1
+            if self.target is not None:
+                self.rate = max(self.target * 0.05, self.rate / 2)
+        time.sleep(min(20, 0.05 * 2 ** attempt) * random.uniform(0.5, 1.0))
+
+    def summary(self):
+        elapsed = max(time.monotonic() - self.started, 0.001)
+        return(f"{self.name}: {self.items} items in {elapsed:.1f}s ({self.items / elapsed:.1f} items/sec), "
+               f"{self.units:.1f} capacity units ({self.units / elapsed:.1f}/sec), {self.throttles} throttle events")
+
+
+def make_throttles(client, table_name, fraction):
+    """Return (read, write) throttles targeting fraction of the table's provisioned capacity"""
+    table = client.describe_table(TableName=table_name)['Table']
+    read_target = write_target = None
+    if fraction is not None:
+        if table.get('BillingModeSummary', {}).get('BillingMode') == 'PAY_PER_REQUEST':
+            print(f"{table_name} is on-demand, not limiting its capacity")
+        else:
+            read_target = table['ProvisionedThroughput']['ReadCapacityUnits'] * fraction
+            write_target = table['ProvisionedThroughput']['WriteCapacityUnits'] * fraction
+    return(CapacityThrottle(f"{table_name} reads", read_target), CapacityThrottle(f"{table_name} writes", write_target))
+
+
+def read_page(operation, throttle, **kwargs):
+    """Call scan or query for one page, retrying throttled requests and pacing against throttle"""
+    attempt = 0
+    while True:
+        try:
+            response = operation(ReturnConsumedCapacity='TOTAL', **kwargs)
+        except ClientError as e:
+            if e.response['Error']['Code'] not in THROTTLE_ERRORS or attempt >= MAX_RETRIES:
+                raise
+            throttle.throttled(attempt)
+            attempt += 1
+            continue
+        throttle.consume(response.get('ConsumedCapacity', {}).get('CapacityUnits', 0), len(response['Items']))
+        return(response)
+
+
+def batch_write(client, table_name, requests, throttle):
+    """Send PutRequest/DeleteRequest entries 25 at a time until every one has been processed"""
+    for i in range(0, len(requests), BATCH_WRITE_SIZE):
+        pending = requests[i:i + BATCH_WRITE_SIZE]
+        attempt = 0
+        while pending:
+            try:
+                response = client.batch_write_item(RequestItems={table_name: pending}, ReturnConsumedCapacity='TOTAL')
+            except ClientError as e:
+                if e.response['Error']['Code'] not in THROTTLE_ERRORS or attempt >= MAX_RETRIES:
+                    raise
+                throttle.throttled(attempt)
+                attempt += 1
+                continue
+            unprocessed = response.get('UnprocessedItems', {}).get(table_name, [])
+            consumed = sum(c.get('CapacityUnits', 0) for c in response.get('ConsumedCapacity', []))
+            throttle.consume(consumed, len(pending) - len(unprocessed))
+            if unprocessed:
+                if attempt >= MAX_RETRIES:
+                    raise RuntimeError(f"Gave up writing {len(unprocessed)} items to {table_name} after {attempt} retries")
+                throttle.throttled(attempt)
+                attempt += 1
+            pending = unprocessed
+
+
+def encode_bytes(value):
+    """json.dumps default= for wire format items, writes B and BS values as base64"""
+    if isinstance(value, bytes):
+        return(base64.b64encode(value).decode('ascii'))
+    raise TypeError(f"Can't serialize {type(value)}")
+
+
+def key_value(table, name, value):
+    """Convert a key value given on the command line to the attribute's type in the table"""
+    types = {a['AttributeName']: a['AttributeType'] for a in table['AttributeDefinitions']}
+    if types[name] == 'N':
+        return(Decimal(value))
+    if types[name] == 'B':
+        return(base64.b64decode(value))
+    return(value)
+
+
+def build_expressions(key_condition=None, filter_condition=None, projection=None, raw=True):
+    """Turn boto3 conditions and a list of attribute names into scan/query arguments.
+
+    Every attribute name and value goes through a placeholder, so reserved
+    words and odd characters in names are safe. Values are serialized for the
+    low-level client when raw is set, a resource's client does that itself.
+    """
+    builder = ConditionExpressionBuilder()
+    serializer = TypeSerializer()
+    output = {}
+    names = {}
+    values = {}
+    if key_condition is not None:
+        built = builder.build_expression(key_condition, is_key_condition=True)
+        output['KeyConditionExpression'] = built.condition_expression
+        names.update(built.attribute_name_placeholders)
+        values.update(built.attribute_value_placeholders)
+    if filter_condition is not None:
+        built = builder.build_expression(filter_condition)
+        output['FilterExpression'] = built.condition_expression
+        names.update(built.attribute_name_placeholders)
+        values.update(built.attribute_value_placeholders)
+    if projection:
+        placeholders = [f"#p{i}" for i in range(len(projection))]
+        output['ProjectionExpression'] = ", ".join(placeholders)
+        names.update(zip(placeholders, projection))
+    if names:
+        output['ExpressionAttributeNames'] = names
+    if values:
+        if raw:
+            values = {k: serializer.serialize(v) for k, v in values.items()}
+        output['ExpressionAttributeValues'] = values
+    return(output)
+
+
+def attribute_size(value):
+    """Approximate size of an AttributeValue in bytes, following DynamoDB's item size rules"""
+    (dtype, data), = value.items()
+    if dtype == 'S':
+        return(len(data.encode('utf-8')))
+    if dtype == 'N':
+        return((len(data.lstrip('-').replace('.', '').strip('0')) + 1) // 2 + 1)
+    if dtype == 'B':
+        return(len(data))
+    if dtype in ('BOOL', 'NULL'):
+        return(1)
+    if dtype in ('SS', 'NS', 'BS'):
+        return(sum(attribute_size({dtype[0]: v}) for v in data))
+    if dtype == 'L':
+        return(3 + sum(1 + attribute_size(v) for v in data))
+    return(3 + sum(1 + len(k.encode('utf-8')) + attribute_size(v) for k, v in data.items()))
+
+
+def item_size(item):
+    return(sum(len(name.encode('utf-8')) + attribute_size(value) for name, value in item.items()))
+
+
+def suggest_segments(table_size_bytes):
+    """Number of parallel scan segments for a table of this size"""
+    segments = math.ceil(table_size_bytes / (GB_PER_SEGMENT * 1024 ** 3))
+    return(max(1, min(MAX_SUGGESTED_SEGMENTS, segments)))
+
+
+def segments_arg(value):
+    """argparse type for --segments, a number or 'auto'"""
+    if value == 'auto':
+        return(value)
+    try:
+        segments = int(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError("must be a number or auto")
+    if segments < 1 or segments > 1000000:
+        raise argparse.ArgumentTypeError("must be between 1 and 1000000")
+    return(segments)
+
+
+def resolve_segments(args, client, table_name):
+    """Replace --segments auto with a count sized from the table, and default --workers to it, up to MAX_DEFAULT_WORKERS"""
+    if args.segments == 'auto':
+        size = client.describe_table(TableName=table_name)['Table'].get('TableSizeBytes', 0)
+        args.segments = suggest_segments(size)
+        print(f"Using {args.segments} segments for {table_name} ({size / 1024 ** 3:.1f} GB)")
+    if args.workers is None:
+        args.workers = min(args.segments, MAX_DEFAULT_WORKERS)
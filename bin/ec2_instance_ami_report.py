@@ -19,6 +19,7 @@ import csv
 import argparse
 import logging
 from botocore.exceptions import ClientError
+import org_common
 
 # Set up logging
 logging.basicConfig(level=logging.INFO)
@@ -27,21 +28,6 @@ logger = logging.getLogger()
 # Global AMI hash set to store AMI details (using AMI ID as the key)
 ami_hash = {}
 
-def assume_role(account_id, role_name, role_session_name):
-    """Assume a role in a given AWS account."""
-    sts_client = boto3.client('sts')
-    try:
-        assumed_role_object = sts_client.assume_role(
-            RoleArn=f'arn:aws:iam::{account_id}:role/{role_name}',
-            RoleSessionName=role_session_name
-        )
-        credentials = assumed_role_object['Credentials']
-        logger.info(f"Successfully assumed role in account {account_id}")
-        return credentials
-    except ClientError as e:
-        logger.warning(f"Failed to assume role for account {account_id}: {e}")
-        return None
-
 def get_account_name(account_id):
     """Get the name of the AWS account using the Organizations service."""
     org_client = boto3.client('organizations')
@@ -120,12 +106,6 @@ def get_ec2_instances(region, session, account_id, account_name):
         logger.warning(f"Failed to retrieve EC2 instances in region {region}: {e}")
     return instances
 
-def get_all_regions(session):
-    """Get all available AWS regions."""
-    ec2_client = session.client('ec2')
-    regions = ec2_client.describe_regions()['Regions']
-    return [region['RegionName'] for region in regions]
-
 def list_accounts():
     """Get all AWS account IDs in the organization."""
     org_client = boto3.client('organizations')
@@ -158,31 +138,30 @@ def main():
     parser.add_argument('--assume-role', required=True, help='The IAM Role to assume into each account')
     parser.add_argument('--role-session-name', default='ec2_instance_ami_report', help='The RoleSession Name for assuming the role')
     parser.add_argument('--outfile', default='ec2_instance_report.csv', help='The output CSV file name')
+    parser.add_argument('--region-cache', help='File to cache each account\'s enabled regions in (default: ~/.cache/aws_scripts/regions.json)')
+    parser.add_argument('--region-cache-ttl', type=float, default=org_common.REGION_CACHE_TTL_HOURS, help='Hours before an account\'s cached regions are looked up again, 0 to refresh them all')
     args = parser.parse_args()
 
     # Get all account IDs in the organization
     accounts = list_accounts()
 
     all_instances = []
+    region_cache = org_common.RegionCache(args.region_cache, args.region_cache_ttl)
+    session_pool = org_common.SessionPool(args.assume_role, args.role_session_name)
 
     # Loop through each account and assume the role
     for account_id in accounts:
-        credentials = assume_role(account_id, args.assume_role, args.role_session_name)
-        if credentials is None:
+        # A session with the assumed role credentials
+        session = session_pool.session(account_id)
+        if session is None:
             continue
+        logger.info(f"Successfully assumed role in account {account_id}")
 
         # Get the account name
         account_name = get_account_name(account_id)
 
-        # Create a session with the assumed role credentials
-        session = boto3.Session(
-            aws_access_key_id=credentials['AccessKeyId'],
-            aws_secret_access_key=credentials['SecretAccessKey'],
-            aws_session_token=credentials['SessionToken']
-        )
-
         # Get regions
-        regions = get_all_regions(session)
+        regions = region_cache.regions(account_id, session)
 
         # Get EC2 instances in each region
         for region in regions:
@@ -193,6 +172,8 @@ def main():
             except ClientError as e:
                 logger.warning(f"Region {region} is blocked due to permissions: {e}")
 
+    region_cache.save()
+
     # Write results to CSV
     write_csv(args.outfile, all_instances)
 
@@ -3,18 +3,49 @@
 
 # Python script export all rows of a DDB Table. 
 
-import sys, argparse
+import sys, argparse, os, re
+import threading
 import boto3
+from boto3.dynamodb.types import Binary, TypeDeserializer
+from boto3.dynamodb.conditions import Attr, Key
 from botocore.exceptions import ClientError
 import csv
+import json
+import gzip
+import base64
+import tempfile
+import hashlib
+from decimal import Decimal
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import ddb_common
 from pprint import pprint
 
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+FORMATS = ['csv', 'jsonl', 'jsonl.gz', 'parquet']
+PARQUET_ROW_GROUP = 10000
+
+# Set when the user hits Ctrl-C so segments stop after writing their current page
+stop_export = threading.Event()
+
 
 def do_args():
     parser = argparse.ArgumentParser()
     parser.add_argument("--debug", help="print debugging info", action='store_true')
     parser.add_argument("--source", help="Source Tablename", required=True)
     parser.add_argument("--dest", help="dest filename", required=True)
+    parser.add_argument("--segments", help="Scan in this many parallel segments (or auto to size it from the table) and write one shard file per segment plus a manifest", type=ddb_common.segments_arg, default=1)
+    parser.add_argument("--workers", help="Number of segments to export at the same time (defaults to --segments, at most 32)", type=int)
+    parser.add_argument("--attributes", help="Comma separated list of the only attributes to export")
+    parser.add_argument("--filter", help="Only export items matching NAME=VALUE. Also != < <= > >=, ^= (begins with) and ~= (contains). "
+                        "Values that look like numbers are compared as numbers, quote them (NAME='\"007\"') to compare as a string. "
+                        "Repeat to AND several filters together", action='append', default=[])
+    parser.add_argument("--partition-key", help="Query only the items with this partition key value instead of scanning the whole table")
+    parser.add_argument("--format", help="Output format. jsonl is one DynamoDB JSON item per line, the same as DynamoDB's own export to S3", choices=FORMATS, default='csv')
     # parser.add_argument("--key_attribute", help="primary key")
 
     args = parser.parse_args()
@@ -28,35 +59,331 @@ def do_args():
     # if args.key_attribute == "":
     #     print "Must specify --key_attribute"
     #     exit(1)
+    if args.partition_key is not None:
+        if args.segments == 'auto':
+            args.segments = 1
+        if args.segments > 1:
+            print("--partition-key queries can't be split into --segments")
+            exit(1)
+    if args.workers is not None and args.workers < 1:
+        print("--workers must be at least 1")
+        exit(1)
+    if args.format == 'parquet' and pyarrow is None:
+        print("--format parquet needs pyarrow (pip install pyarrow)")
+        exit(1)
 
     return(args)
 
+FILTER_OPERATORS = {
+    '=': lambda attr, value: attr.eq(value),
+    '!=': lambda attr, value: attr.ne(value),
+    '<': lambda attr, value: attr.lt(value),
+    '<=': lambda attr, value: attr.lte(value),
+    '>': lambda attr, value: attr.gt(value),
+    '>=': lambda attr, value: attr.gte(value),
+    '^=': lambda attr, value: attr.begins_with(value),
+    '~=': lambda attr, value: attr.contains(value),
+}
+
+def parse_filter(text):
+    match = re.match(r'^(.+?)(<=|>=|!=|\^=|~=|=|<|>)(.*)$', text)
+    if not match:
+        print(f"Can't parse --filter {text}")
+        exit(1)
+    name, operator, value = match.groups()
+    if len(value) >= 2 and value[0] == value[-1] == '"':
+        value = value[1:-1]
+    else:
+        try:
+            number = Decimal(value)
+            if number.is_finite():
+                value = number
+        except ArithmeticError:
+            pass
+    return(FILTER_OPERATORS[operator](Attr(name), value))
+
+def read_args(args):
+    """The query or scan arguments for the --attributes, --filter and --partition-key options"""
+    key_condition = None
+    if args.partition_key is not None:
+        table = boto3.client('dynamodb').describe_table(TableName=args.source)['Table']
+        hash_key = [k['AttributeName'] for k in table['KeySchema'] if k['KeyType'] == 'HASH'][0]
+        key_condition = Key(hash_key).eq(ddb_common.key_value(table, hash_key, args.partition_key))
+
+    filter_condition = None
+    for text in args.filter:
+        condition = parse_filter(text)
+        filter_condition = condition if filter_condition is None else filter_condition & condition
+
+    projection = None
+    if args.attributes:
+        projection = [a.strip() for a in args.attributes.split(',') if a.strip()]
+
+    return(ddb_common.build_expressions(key_condition, filter_condition, projection))
+
+def scan_pages(args, segment=0):
+    """Yield each page of items from the source table (or one segment of it) in DynamoDB's wire format"""
+    # boto3 sessions are not thread safe, so every segment builds its own
+    client = boto3.Session().client('dynamodb')
+    operation = client.query if args.partition_key is not None else client.scan
+    scan_args = {'TableName': args.source}
+    scan_args.update(args.read_args)
+    if args.segments > 1:
+        scan_args['Segment'] = segment
+        scan_args['TotalSegments'] = args.segments
+    response = operation(**scan_args)
+    while True:
+        yield(response['Items'])
+        if 'LastEvaluatedKey' not in response or stop_export.is_set():
+            break
+        response = operation(ExclusiveStartKey=response['LastEvaluatedKey'], **scan_args)
+
+def to_json(item):
+    return(json.dumps({'Item': item}, default=ddb_common.encode_bytes))
+
+def csv_value(value):
+    # The same text csv.writer would have produced for the value
+    if value is None:
+        return("")
+    if isinstance(value, Binary):
+        # str() of a Binary is bytes, which csv can't write
+        return(base64.b64encode(value.value).decode('ascii'))
+    return(str(value))
+
+def export_csv(pages, dest, debug, show_columns=True):
+    deserializer = TypeDeserializer()
+
+    # Rows are spilled to disk as they are scanned, only the header stays in memory.
+    # A dict keeps the attribute names in the order they were first seen.
+    header = {}
+    count = 0
+    spill_dir = os.path.dirname(os.path.abspath(dest))
+    with tempfile.TemporaryFile(mode='w+', dir=spill_dir) as spill:
+        for page in pages:
+            for item in page:
+                header.update(dict.fromkeys(item))
+                spill.write(json.dumps({k: csv_value(deserializer.deserialize(v)) for k, v in item.items()}) + "\n")
+            count += len(page)
+            if debug:
+                print(f"Scanned {count} items")
+
+        unique_keys = list(header)
+        # Shards print from several threads at once, where the lists would interleave
+        if show_columns:
+            print(unique_keys)
+
+        # Second pass now the full header is known
+        spill.seek(0)
+        csvfile = open(dest, 'w')
+        writer = csv.DictWriter(csvfile, delimiter=',', quotechar='"', quoting=csv.QUOTE_ALL, fieldnames=unique_keys)
+        writer.writeheader()
+        for line in spill:
+            writer.writerow(json.loads(line))
+        csvfile.close()
+    return(count)
+
+def export_jsonl(pages, dest, debug, compress=False):
+    count = 0
+    if compress:
+        outfile = gzip.open(dest, 'wt')
+    else:
+        outfile = open(dest, 'w')
+    with outfile:
+        for page in pages:
+            outfile.write("".join(to_json(item) + "\n" for item in page))
+            count += len(page)
+            if debug:
+                print(f"Wrote {count} items")
+    return(count)
+
+def number_kind(value):
+    """int or float if the number fits one without losing anything, otherwise decimal"""
+    number = Decimal(value)
+    if number == number.to_integral_value() and -2**63 <= number < 2**63:
+        return('int')
+    if len(number.normalize().as_tuple().digits) <= 15:
+        return('float')
+    return('decimal')
+
+KIND_ORDER = ['int', 'float', 'decimal']
+# Integers past this don't survive a trip through float64
+FLOAT_EXACT_INT = 2**53
+
+class ParquetColumn(object):
+    """Tracks the DynamoDB types seen for one attribute to pick its Parquet type"""
+
+    def __init__(self):
+        self.types = set()
+        self.number = 'int'
+        self.wide_int = False
+
+    def add(self, value):
+        (dtype, data), = value.items()
+        if dtype == 'NULL':
+            return
+        self.types.add(dtype)
+        if dtype == 'N':
+            data = [data]
+        if dtype in ('N', 'NS'):
+            for n in data:
+                kind = number_kind(n)
+                if kind == 'int' and abs(int(n)) > FLOAT_EXACT_INT:
+                    self.wide_int = True
+                if KIND_ORDER.index(kind) > KIND_ORDER.index(self.number):
+                    self.number = kind
+            # A column of ints and floats becomes float64, unless that would round one of the ints
+            if self.number == 'float' and self.wide_int:
+                self.number = 'decimal'
+
+    def arrow_type(self):
+        # Attributes with one scalar or set type keep it. Maps, lists, numbers that
+        # don't fit int64/float64 and attributes with mixed types are written as
+        # DynamoDB JSON strings so nothing is lost.
+        if len(self.types) != 1 or self.number == 'decimal':
+            return(None)
+        dtype = next(iter(self.types))
+        number = pyarrow.int64() if self.number == 'int' else pyarrow.float64()
+        return({
+            'S': pyarrow.string(),
+            'N': number,
+            'B': pyarrow.binary(),
+            'BOOL': pyarrow.bool_(),
+            'SS': pyarrow.list_(pyarrow.string()),
+            'NS': pyarrow.list_(number),
+            'BS': pyarrow.list_(pyarrow.binary()),
+        }.get(dtype))
+
+    def convert(self, value, arrow_type):
+        if value is None or 'NULL' in value:
+            return(None)
+        if arrow_type is None:
+            return(json.dumps(value, default=ddb_common.encode_bytes))
+        (dtype, data), = value.items()
+        if dtype == 'N':
+            return(int(data) if self.number == 'int' else float(data))
+        if dtype == 'NS':
+            return([int(n) if self.number == 'int' else float(n) for n in data])
+        return(data)
+
+def export_parquet(pages, dest, debug):
+    # Parquet needs the schema up front, so spill the items and work out
+    # each column's type while scanning, then write row groups in a second pass.
+    columns = {}
+    count = 0
+    spill_dir = os.path.dirname(os.path.abspath(dest))
+    with tempfile.TemporaryFile(mode='w+', dir=spill_dir) as spill:
+        for page in pages:
+            for item in page:
+                for name, value in item.items():
+                    if name not in columns:
+                        columns[name] = ParquetColumn()
+                    columns[name].add(value)
+                spill.write(json.dumps(item, default=ddb_common.encode_bytes) + "\n")
+            count += len(page)
+            if debug:
+                print(f"Scanned {count} items")
+
+        arrow_types = {name: column.arrow_type() for name, column in columns.items()}
+        schema = pyarrow.schema([(name, t if t else pyarrow.string()) for name, t in arrow_types.items()])
+
+        spill.seek(0)
+        with pyarrow.parquet.ParquetWriter(dest, schema) as writer:
+            rows = []
+            for line in spill:
+                rows.append(json.loads(line))
+                if len(rows) == PARQUET_ROW_GROUP:
+                    writer.write_table(parquet_table(rows, columns, arrow_types, schema))
+                    rows = []
+            if rows or count == 0:
+                writer.write_table(parquet_table(rows, columns, arrow_types, schema))
+    return(count)
+
+def parquet_table(rows, columns, arrow_types, schema):
+    data = {}
+    for name, column in columns.items():
+        values = []
+        for row in rows:
+            value = row.get(name)
+            # The spill file holds binary as base64
+            if value is not None and arrow_types[name] is not None:
+                if 'B' in value:
+                    value = {'B': base64.b64decode(value['B'])}
+                elif 'BS' in value:
+                    value = {'BS': [base64.b64decode(b) for b in value['BS']]}
+            values.append(column.convert(value, arrow_types[name]))
+        data[name] = values
+    return(pyarrow.Table.from_pydict(data, schema=schema))
+
+def export(pages, dest, args):
+    if args.format == 'csv':
+        return(export_csv(pages, dest, args.debug, show_columns=args.segments == 1))
+    elif args.format == 'parquet':
+        return(export_parquet(pages, dest, args.debug))
+    else:
+        return(export_jsonl(pages, dest, args.debug, compress=args.format == 'jsonl.gz'))
+
+def shard_base(args):
+    # dest.jsonl.gz becomes dest.part-0007.jsonl.gz and dest.manifest.json
+    suffix = f".{args.format}"
+    if args.dest.endswith(suffix):
+        return(args.dest[:-len(suffix)])
+    return(args.dest)
+
+def export_shard(args, segment):
+    shard = f"{shard_base(args)}.part-{segment:04d}.{args.format}"
+    count = export(scan_pages(args, segment), shard, args)
+    sha256 = hashlib.sha256()
+    with open(shard, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            sha256.update(chunk)
+    return({
+        'file': os.path.basename(shard),
+        'segment': segment,
+        'items': count,
+        'bytes': os.path.getsize(shard),
+        'sha256': sha256.hexdigest()
+    })
+
 def main(args):
-    # Connect to the table.
-    dynamodb = boto3.resource('dynamodb')
-    src_table = dynamodb.Table(args.source)
-
-    all_items = []
-    all_keys = []
-    response = src_table.scan()
-    while 'LastEvaluatedKey' in response :
-        for item in response['Items']:
-            all_items.append(item)
-            all_keys += item.keys()
-        response = src_table.scan(ExclusiveStartKey=response['LastEvaluatedKey'])
-    for item in response['Items']:
-        all_items.append(item)
-        all_keys += item.keys()
-
-    unique_keys = list(dict.fromkeys(all_keys))
-    print(unique_keys)
-
-    csvfile = open(args.dest, 'w')
-    writer = csv.DictWriter(csvfile, delimiter=',', quotechar='"', quoting=csv.QUOTE_ALL, fieldnames=unique_keys)
-    writer.writeheader()
-    for i in all_items:
-        writer.writerow(i)
-    csvfile.close()
+    ddb_common.resolve_segments(args, boto3.client('dynamodb'), args.source)
+    args.read_args = read_args(args)
+    if args.debug:
+        print(args.read_args)
+
+    if args.segments == 1:
+        count = export(scan_pages(args), args.dest, args)
+        print(f"Wrote {count} items to {args.dest}")
+        return
+
+    shards = []
+    executor = ThreadPoolExecutor(max_workers=args.workers)
+    try:
+        futures = [executor.submit(export_shard, args, segment) for segment in range(args.segments)]
+        for future in as_completed(futures):
+            shard = future.result()
+            shards.append(shard)
+            print(f"Wrote {shard['items']} items to {shard['file']}")
+    except BaseException:
+        # Ctrl-C or a failed segment, let the other segments finish their current page and stop.
+        # The shards are incomplete, so no manifest is written.
+        print("Stopping, waiting for in-flight pages to be written")
+        stop_export.set()
+        executor.shutdown(wait=True, cancel_futures=True)
+        raise
+    executor.shutdown()
+
+    shards.sort(key=lambda shard: shard['segment'])
+    manifest_file = f"{shard_base(args)}.manifest.json"
+    manifest = {
+        'table': args.source,
+        'format': args.format,
+        'segments': args.segments,
+        'items': sum(shard['items'] for shard in shards),
+        'shards': shards
+    }
+    with open(manifest_file, 'w') as f:
+        json.dump(manifest, f, indent=2)
+    print(f"Wrote {manifest['items']} items in {len(shards)} shards, manifest is {manifest_file}")
 
 
 if __name__ == '__main__':
@@ -19,7 +19,9 @@ import csv
 import argparse
 import logging
 from botocore.exceptions import ClientError
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
 from datetime import datetime, timedelta, timezone
+import org_common
 
 # Set up logging
 logging.basicConfig(level=logging.INFO)
@@ -29,24 +31,8 @@ logging.getLogger('urllib3').setLevel(logging.WARNING)
 logger = logging.getLogger()
 
 
-def assume_role(account_id, role_name, role_session_name):
-    """Assume a role in a given AWS account."""
-    sts_client = boto3.client('sts')
-    try:
-        assumed_role_object = sts_client.assume_role(
-            RoleArn=f'arn:aws:iam::{account_id}:role/{role_name}',
-            RoleSessionName=role_session_name
-        )
-        credentials = assumed_role_object['Credentials']
-        logger.debug(f"Successfully assumed role in account {account_id}")
-        return credentials
-    except ClientError as e:
-        logger.warning(f"Failed to assume role for account {account_id}: {e}")
-        return None
-
-def get_account_name(account_id):
+def get_account_name(org_client, account_id):
     """Get the name of the AWS account using the Organizations service."""
-    org_client = boto3.client('organizations')
     try:
         account = org_client.describe_account(AccountId=account_id)
         return account['Account']['Name']
@@ -54,12 +40,6 @@ def get_account_name(account_id):
         logger.warning(f"Failed to retrieve account name for account {account_id}: {e}")
         return 'N/A'
 
-def get_all_regions(session):
-    """Get all available AWS regions."""
-    ec2_client = session.client('ec2')
-    regions = ec2_client.describe_regions()['Regions']
-    return [region['RegionName'] for region in regions]
-
 def list_accounts():
     """Get all AWS account IDs in the organization."""
     org_client = boto3.client('organizations')
@@ -74,10 +54,84 @@ def list_accounts():
         raise
     return accounts
 
+def prepare_account(session_pool, org_client, region_cache, account_id):
+    """
+    Assume the role into an account and build CloudWatch and EC2 clients for each of its regions.
+
+    The account's session is only used from this thread, boto3 sessions aren't thread safe,
+    but the clients it makes are and get shared with the region tasks.
+    :return: A list of (account_id, account_name, region, cloudwatch client, ec2 client), empty if the role can't be assumed.
+    """
+    # The account's session, with the assumed role credentials
+    session = session_pool.session(account_id)
+    if session is None:
+        return []
+
+    # Get the account name
+    account_name = get_account_name(org_client, account_id)
+
+    # Get regions
+    regions = region_cache.regions(account_id, session)
+    # regions=["us-east-1"]
+
+    return [(account_id, account_name, region, session.client('cloudwatch', region_name=region), session.client('ec2', region_name=region))
+            for region in regions]
+
+def get_instances(ec2):
+    """Get the instances in a region with their IMDS settings."""
+    instances = []
+    for page in ec2.get_paginator('describe_instances').paginate():
+        for reservation in page['Reservations']:
+            for instance in reservation['Instances']:
+                metadata_options = instance.get('MetadataOptions', {})
+                instances.append({
+                    'InstanceId': instance['InstanceId'],
+                    'InstanceName': next((tag['Value'] for tag in instance.get('Tags', []) if tag['Key'] == 'Name'), 'N/A'),
+                    'State': instance['State']['Name'],
+                    'HttpTokens': metadata_options.get('HttpTokens', 'N/A'),
+                    'HttpEndpoint': metadata_options.get('HttpEndpoint', 'N/A'),
+                })
+    return instances
+
+def check_region(account_id, account_name, region, cloudwatch, ec2):
+    """
+    Return (account_name, account_id, region, count, instances), count is None if the region couldn't be read.
+
+    instances are the ones that still allow IMDSv1 or made IMDSv1 calls this week, with an IMDSv1Calls count.
+    """
+    logger.debug(f"Processing region {region} for account {account_name} ({account_id})")
+    try:
+        count = get_last_week_metric_total(cloudwatch)
+        instances = get_instances(ec2)
+        # The region total covers every instance, so only look per instance when it's not zero
+        calls = get_last_week_instance_totals(cloudwatch, [i['InstanceId'] for i in instances]) if count else {}
+    except ClientError as e:
+        logger.warning(f"Region {region} is blocked due to permissions: {e}")
+        return (account_name, account_id, region, None, [])
+    flagged = []
+    for instance in instances:
+        instance['IMDSv1Calls'] = int(calls.get(instance['InstanceId'], 0))
+        if instance['HttpTokens'] == 'optional' or instance['IMDSv1Calls']:
+            flagged.append(dict(instance, AccountId=account_id, AccountName=account_name, Region=region))
+    return (account_name, account_id, region, count, flagged)
+
+def write_csv(outfile, data):
+    """Write the per instance IMDSv1 data to a CSV file."""
+    fieldnames = ['AccountId', 'AccountName', 'Region', 'InstanceId', 'InstanceName', 'State', 'HttpTokens', 'HttpEndpoint', 'IMDSv1Calls']
+    with open(outfile, mode='w', newline='') as file:
+        writer = csv.DictWriter(file, fieldnames=fieldnames)
+        writer.writeheader()
+        writer.writerows(data)
+    logger.info(f"CSV report written to {outfile}")
+
 def main():
     parser = argparse.ArgumentParser(description='Fetch EC2 instance and AMI details across all accounts in the organization.')
     parser.add_argument('--assume-role', required=True, help='The IAM Role to assume into each account')
     parser.add_argument('--role-session-name', default='imdsv1-usage-report', help='The RoleSession Name for assuming the role')
+    parser.add_argument('--workers', type=int, default=16, help='Number of accounts and regions to check at the same time')
+    parser.add_argument('--outfile', help='Write every instance that allows IMDSv1 or made IMDSv1 calls, with its call count, to this CSV file')
+    parser.add_argument('--region-cache', help='File to cache each account\'s enabled regions in (default: ~/.cache/aws_scripts/regions.json)')
+    parser.add_argument('--region-cache-ttl', type=float, default=org_common.REGION_CACHE_TTL_HOURS, help='Hours before an account\'s cached regions are looked up again, 0 to refresh them all')
     parser.add_argument('--debug', action='store_true', help='Enable debug-level logging')
     args = parser.parse_args()
 
@@ -90,46 +144,68 @@ def main():
     # Get all account IDs in the organization
     accounts = list_accounts()
 
-    # Loop through each account and assume the role
-    for account_id in accounts:
-        credentials = assume_role(account_id, args.assume_role, args.role_session_name)
-        if credentials is None:
-            continue
-
-        # Get the account name
-        account_name = get_account_name(account_id)
-
-        # Create a session with the assumed role credentials
-        session = boto3.Session(
-            aws_access_key_id=credentials['AccessKeyId'],
-            aws_secret_access_key=credentials['SecretAccessKey'],
-            aws_session_token=credentials['SessionToken']
-        )
-
-        # Get regions
-        regions = get_all_regions(session)
-        # regions=["us-east-1"]
-
-        # Get EC2 instances in each region
-        for region in regions:
-            logger.debug(f"Processing region {region} for account {account_name} ({account_id})")
-            try:
-                count = get_last_week_metric_total(session, region)
-                if count != 0:
-                    print(f"{account_name}({account_id}) - {region}: {int(count)} IMDSv1 calls in the last week")
-            except ClientError as e:
-                logger.warning(f"Region {region} is blocked due to permissions: {e}")
-
-def get_last_week_metric_total(session, region, namespace='AWS/EC2', metric_name='MetadataNoToken'):
+    # Clients are thread safe, so every account shares this one
+    org_client = boto3.client('organizations')
+    session_pool = org_common.SessionPool(args.assume_role, args.role_session_name)
+    region_cache = org_common.RegionCache(args.region_cache, args.region_cache_ttl)
+
+    # Accounts and their regions share one pool. As each account is prepared its regions are queued behind it,
+    # and results are logged as they arrive. Each account's session and clients take tens of MB, so only
+    # --workers accounts are in flight at once, the next one starts when an account's last region is done.
+    results = []
+    instances = []
+    remaining = {}
+    account_queue = iter(accounts)
+    with ThreadPoolExecutor(max_workers=args.workers) as executor:
+        def start_next_account():
+            account_id = next(account_queue, None)
+            if account_id is not None:
+                pending.add(executor.submit(prepare_account, session_pool, org_client, region_cache, account_id))
+
+        pending = set()
+        for _ in range(args.workers):
+            start_next_account()
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                result = future.result()
+                if isinstance(result, list):
+                    if not result:
+                        start_next_account()
+                        continue
+                    remaining[result[0][0]] = len(result)
+                    pending |= {executor.submit(check_region, *work) for work in result}
+                    continue
+                account_name, account_id, region, count, flagged = result
+                remaining[account_id] -= 1
+                if not remaining[account_id]:
+                    del remaining[account_id]
+                    start_next_account()
+                instances.extend(flagged)
+                if count:
+                    logger.info(f"{account_name}({account_id}) - {region}: {int(count)} IMDSv1 calls in the last week")
+                    results.append((account_name, account_id, region, count, flagged))
+
+    region_cache.save()
+
+    for account_name, account_id, region, count, flagged in sorted(results, key=lambda r: r[:3]):
+        print(f"{account_name}({account_id}) - {region}: {int(count)} IMDSv1 calls in the last week")
+        for instance in sorted(flagged, key=lambda i: -i['IMDSv1Calls']):
+            if instance['IMDSv1Calls']:
+                print(f"    {instance['InstanceId']} ({instance['InstanceName']}): {instance['IMDSv1Calls']} calls, HttpTokens {instance['HttpTokens']}")
+
+    if args.outfile:
+        write_csv(args.outfile, sorted(instances, key=lambda i: (i['AccountName'], i['AccountId'], i['Region'], -i['IMDSv1Calls'])))
+
+def get_last_week_metric_total(cloudwatch, namespace='AWS/EC2', metric_name='MetadataNoToken'):
     """
     Retrieves the total sum of the CloudWatch metric 'MetadataNoToken' for the last week.
 
-    :param session: A valid boto3 session for the target AWS account and region.
+    :param cloudwatch: A CloudWatch client for the target AWS account and region.
     :param namespace: The CloudWatch namespace for the metric.
     :param metric_name: The name of the metric.
     :return: The total sum of the metric over the last week.
     """
-    cloudwatch = session.client('cloudwatch', region_name=region)
 
     end_time = datetime.now(timezone.utc)
     start_time = end_time - timedelta(days=7)
@@ -146,6 +222,35 @@ def get_last_week_metric_total(session, region, namespace='AWS/EC2', metric_name
     total = sum(dp['Sum'] for dp in response.get('Datapoints', []))
     return total
 
+def get_last_week_instance_totals(cloudwatch, instance_ids, namespace='AWS/EC2', metric_name='MetadataNoToken'):
+    """
+    Retrieves the last week's sum of 'MetadataNoToken' for each instance, 500 instances per get_metric_data call.
+
+    :param cloudwatch: A CloudWatch client for the target AWS account and region.
+    :param instance_ids: The instances to look up.
+    :return: A dict of instance ID to the total, instances with no data are left out.
+    """
+    end_time = datetime.now(timezone.utc)
+    start_time = end_time - timedelta(days=7)
+
+    totals = {}
+    for i in range(0, len(instance_ids), 500):  # get_metric_data limit is 500 queries
+        batch = instance_ids[i:i + 500]
+        queries = [{
+            'Id': f'm{n}',
+            'MetricStat': {
+                'Metric': {'Namespace': namespace, 'MetricName': metric_name, 'Dimensions': [{'Name': 'InstanceId', 'Value': instance_id}]},
+                'Period': 3600,
+                'Stat': 'Sum'
+            }
+        } for n, instance_id in enumerate(batch)]
+        for page in cloudwatch.get_paginator('get_metric_data').paginate(MetricDataQueries=queries, StartTime=start_time, EndTime=end_time):
+            for result in page['MetricDataResults']:
+                if result['Values']:
+                    instance_id = batch[int(result['Id'][1:])]
+                    totals[instance_id] = totals.get(instance_id, 0) + sum(result['Values'])
+    return totals
+
 
 if __name__ == '__main__':
     try:
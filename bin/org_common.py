@@ -0,0 +1,152 @@
+# Helpers shared by the scripts that crawl every account in the organization.
+# Not a script itself, the scripts import it from the bin directory.
+
+import os
+import json
+import time
+import threading
+import logging
+from datetime import datetime, timezone
+import boto3
+import botocore.session
+from botocore.credentials import RefreshableCredentials
+from botocore.exceptions import ClientError
+
+logger = logging.getLogger()
+
+CACHE_DIR = os.path.join(os.environ.get('XDG_CACHE_HOME', os.path.expanduser('~/.cache')), 'aws_scripts')
+REGION_CACHE_TTL_HOURS = 24
+# Cached role credentials closer than this to expiring are replaced. botocore refreshes
+# 15 minutes before expiry, this has to be longer so the refresh gets new credentials.
+CREDENTIAL_REFRESH_SECONDS = 20 * 60
+
+
+def get_enabled_regions(session):
+    """Get the regions enabled in the session's account, skipping opt-in regions that aren't opted in."""
+    ec2_client = session.client('ec2')
+    regions = ec2_client.describe_regions(AllRegions=False)['Regions']
+    return [region['RegionName'] for region in regions if region['OptInStatus'] in ('opt-in-not-required', 'opted-in')]
+
+
+class RegionCache(object):
+    """
+    Each account's enabled regions, kept on disk so a crawl only calls describe_regions for accounts it
+    hasn't seen within the TTL. Safe to share between threads, call save() once the crawl is done.
+    """
+
+    def __init__(self, filename=None, ttl_hours=REGION_CACHE_TTL_HOURS):
+        self.filename = filename or os.path.join(CACHE_DIR, 'regions.json')
+        self.ttl = ttl_hours * 3600
+        self.lock = threading.Lock()
+        self.accounts = {}
+        try:
+            with open(self.filename) as f:
+                self.accounts = json.load(f)
+        except FileNotFoundError:
+            pass
+        except ValueError as e:
+            logger.warning(f"Ignoring unreadable region cache {self.filename}: {e}")
+
+    def regions(self, account_id, session):
+        """The account's enabled regions, from the cache if they're fresh enough or else from describe_regions."""
+        with self.lock:
+            cached = self.accounts.get(account_id)
+        if cached and time.time() - cached['Fetched'] < self.ttl:
+            logger.debug(f"Using cached regions for {account_id}")
+            return cached['Regions']
+        regions = get_enabled_regions(session)
+        with self.lock:
+            self.accounts[account_id] = {'Regions': regions, 'Fetched': time.time()}
+        return regions
+
+    def save(self):
+        """Write the cache, through a temporary file so a crash never leaves it half written."""
+        os.makedirs(os.path.dirname(os.path.abspath(self.filename)), exist_ok=True)
+        with self.lock:
+            with open(self.filename + '.tmp', 'w') as f:
+                json.dump(self.accounts, f, indent=2)
+        os.replace(self.filename + '.tmp', self.filename)
+
+
+class SessionPool(object):
+    """
+    One boto3 Session per account, for a role assumed into every account in the organization.
+
+    Role credentials are cached on disk, readable only by the user, so later runs skip AssumeRole
+    while they're still good. The sessions use botocore's RefreshableCredentials, which assume the
+    role again shortly before the credentials expire, so a crawl can run past the session limit.
+    Sessions aren't thread safe, create each account's clients from one thread at a time.
+    Sessions aren't kept, drop an account's session and clients once done with it so they can be freed.
+    """
+
+    def __init__(self, role_name, role_session_name, cache_dir=None):
+        self.role_name = role_name
+        self.role_session_name = role_session_name
+        self.cache_dir = cache_dir or os.path.join(CACHE_DIR, 'credentials')
+        # Clients are thread safe, so every account shares this one
+        self.sts_client = boto3.client('sts')
+        # Every session shares one loader, so the service models are only read and kept in memory once.
+        # boto3 adds its own data directory to a session's loader, so take one that already has it
+        # and put its search paths back after each new session adds it again.
+        self.lock = threading.Lock()
+        botocore_session = botocore.session.get_session()
+        boto3.Session(botocore_session=botocore_session)
+        self.loader = botocore_session.get_component('data_loader')
+        self.search_paths = list(self.loader.search_paths)
+
+    def cache_file(self, account_id):
+        return os.path.join(self.cache_dir, f"{account_id}-{self.role_name}-{self.role_session_name}.json")
+
+    def credentials(self, account_id):
+        """The role's credentials in the account as refresh metadata, from the cache if they're not about to expire."""
+        try:
+            with open(self.cache_file(account_id)) as f:
+                cached = json.load(f)
+            expiry = datetime.fromisoformat(cached['expiry_time'])
+            if (expiry - datetime.now(timezone.utc)).total_seconds() > CREDENTIAL_REFRESH_SECONDS:
+                logger.debug(f"Using cached credentials for account {account_id}")
+                return cached
+        except FileNotFoundError:
+            pass
+        except (ValueError, KeyError) as e:
+            logger.warning(f"Ignoring unreadable cached credentials for account {account_id}: {e}")
+
+        response = self.sts_client.assume_role(
+            RoleArn=f'arn:aws:iam::{account_id}:role/{self.role_name}',
+            RoleSessionName=self.role_session_name
+        )
+        logger.debug(f"Successfully assumed role in account {account_id}")
+        credentials = response['Credentials']
+        metadata = {
+            'access_key': credentials['AccessKeyId'],
+            'secret_key': credentials['SecretAccessKey'],
+            'token': credentials['SessionToken'],
+            'expiry_time': credentials['Expiration'].isoformat(),
+        }
+        # Credentials are secrets, the directory and files are only readable by the user
+        os.makedirs(self.cache_dir, mode=0o700, exist_ok=True)
+        tmp_file = f"{self.cache_file(account_id)}.{threading.get_ident()}.tmp"
+        with os.fdopen(os.open(tmp_file, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), 'w') as f:
+            json.dump(metadata, f)
+        os.replace(tmp_file, self.cache_file(account_id))
+        return metadata
+
+    def session(self, account_id):
+        """A new boto3 Session in the account, None if the role can't be assumed."""
+        try:
+            credentials = RefreshableCredentials.create_from_metadata(
+                metadata=self.credentials(account_id),
+                refresh_using=lambda: self.credentials(account_id),
+                method='assume-role'
+            )
+        except ClientError as e:
+            logger.warning(f"Failed to assume role for account {account_id}: {e}")
+            return None
+        botocore_session = botocore.session.get_session()
+        botocore_session.register_component('data_loader', self.loader)
+        # botocore has no public way to hand a session refreshable credentials
+        botocore_session._credentials = credentials
+        with self.lock:
+            session = boto3.Session(botocore_session=botocore_session)
+            self.loader.search_paths[:] = self.search_paths
+        return session
@@ -0,0 +1,148 @@
+#!/usr/bin/env python3
+
+
+# Python script to estimate the size and cost of a DDB Table from a sample of its scan segments.
+
+import sys, argparse, os
+import math, random, statistics, time
+import boto3
+from botocore.exceptions import ClientError
+from concurrent.futures import ThreadPoolExecutor
+import ddb_common
+
+# On-demand prices in us-east-1, $ per million request units
+READ_PRICE = 0.125
+WRITE_PRICE = 0.625
+
+SAMPLE_SEGMENT_BYTES = 64 * 1024 ** 2
+MIN_TOTAL_SEGMENTS = 20
+MAX_DISTINCT_VALUES = 1000
+
+# Two sided 95% t values by degrees of freedom, 1.96 past the end
+T_95 = {1: 12.71, 2: 4.30, 3: 3.18, 4: 2.78, 5: 2.57, 6: 2.45, 7: 2.36, 8: 2.31, 9: 2.26, 10: 2.23,
+        12: 2.18, 15: 2.13, 20: 2.09, 25: 2.06, 30: 2.04}
+
+def do_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--debug", help="print debugging info", action='store_true')
+    parser.add_argument("--table", help="Tablename", required=True)
+    parser.add_argument("--sample-segments", help="Number of scan segments to read", type=int, default=10)
+    parser.add_argument("--total-segments", help="Split the table into this many segments (default: about 64MB each)", type=int)
+    parser.add_argument("--read-price", help="$ per million read request units", type=float, default=READ_PRICE)
+    parser.add_argument("--write-price", help="$ per million write request units", type=float, default=WRITE_PRICE)
+
+    args = parser.parse_args()
+
+    if args.sample_segments < 2:
+        print("--sample-segments must be at least 2")
+        exit(1)
+    if args.total_segments is not None and not args.sample_segments <= args.total_segments <= 1000000:
+        print("--total-segments must be at least --sample-segments and at most 1000000")
+        exit(1)
+
+    return(args)
+
+def t_value(degrees):
+    for d in sorted(T_95, reverse=True):
+        if degrees >= d:
+            return(T_95[d] if degrees <= 30 else 1.96)
+    return(T_95[1])
+
+def sample_segment(args, segment, total_segments):
+    # boto3 sessions are not thread safe, so every segment builds its own
+    client = boto3.Session().client('dynamodb')
+    scan_args = {'TableName': args.table, 'Segment': segment, 'TotalSegments': total_segments, 'ReturnConsumedCapacity': 'TOTAL'}
+    sample = {'items': 0, 'bytes': 0, 'write_units': 0, 'read_units': 0.0, 'attributes': {}}
+    started = time.monotonic()
+    response = client.scan(**scan_args)
+    while True:
+        sample['read_units'] += response.get('ConsumedCapacity', {}).get('CapacityUnits', 0)
+        for item in response['Items']:
+            size = ddb_common.item_size(item)
+            sample['items'] += 1
+            sample['bytes'] += size
+            sample['write_units'] += max(1, math.ceil(size / 1024))
+            for name, value in item.items():
+                attribute = sample['attributes'].setdefault(name, {'count': 0, 'values': set()})
+                attribute['count'] += 1
+                if len(attribute['values']) <= MAX_DISTINCT_VALUES:
+                    attribute['values'].add(repr(value))
+        if 'LastEvaluatedKey' not in response:
+            break
+        response = client.scan(ExclusiveStartKey=response['LastEvaluatedKey'], **scan_args)
+    sample['seconds'] = time.monotonic() - started
+    if args.debug:
+        print(f"Segment {segment}: {sample['items']} items, {sample['bytes']} bytes in {sample['seconds']:.1f}s")
+    return(sample)
+
+def estimate(values, total_segments):
+    """Extrapolate a per-segment measurement to the whole table, with a 95% confidence interval"""
+    n = len(values)
+    total = statistics.mean(values) * total_segments
+    # Finite population correction, we sampled segments without replacement
+    error = statistics.stdev(values) / math.sqrt(n) * math.sqrt((total_segments - n) / (total_segments - 1)) * total_segments
+    margin = t_value(n - 1) * error
+    return(total, max(0, total - margin), total + margin)
+
+def main(args):
+    client = boto3.client('dynamodb')
+    table = client.describe_table(TableName=args.table)['Table']
+
+    total_segments = args.total_segments
+    if total_segments is None:
+        total_segments = max(MIN_TOTAL_SEGMENTS, math.ceil(table.get('TableSizeBytes', 0) / SAMPLE_SEGMENT_BYTES))
+    sample_segments = min(args.sample_segments, total_segments)
+    segments = sorted(random.sample(range(total_segments), sample_segments))
+
+    print(f"Sampling {sample_segments} of {total_segments} segments of {args.table}")
+    with ThreadPoolExecutor(max_workers=sample_segments) as executor:
+        samples = list(executor.map(lambda segment: sample_segment(args, segment, total_segments), segments))
+
+    items = estimate([s['items'] for s in samples], total_segments)
+    size = estimate([s['bytes'] for s in samples], total_segments)
+    write_units = estimate([s['write_units'] for s in samples], total_segments)
+    sampled_items = sum(s['items'] for s in samples)
+    sampled_bytes = sum(s['bytes'] for s in samples)
+
+    print(f"DescribeTable (updated about every 6 hours): {table.get('ItemCount', 0)} items, {table.get('TableSizeBytes', 0)} bytes")
+    print(f"Estimated items: {items[0]:.0f} (95% CI {items[1]:.0f} - {items[2]:.0f})")
+    print(f"Estimated size: {size[0] / 1024 ** 2:.1f} MB (95% CI {size[1] / 1024 ** 2:.1f} - {size[2] / 1024 ** 2:.1f} MB)")
+    if sampled_items:
+        print(f"Average item size: {sampled_bytes / sampled_items:.0f} bytes")
+
+    print(f"Attributes in {sampled_items} sampled items:")
+    attributes = {}
+    for sample in samples:
+        for name, attribute in sample['attributes'].items():
+            merged = attributes.setdefault(name, {'count': 0, 'values': set()})
+            merged['count'] += attribute['count']
+            merged['values'] |= attribute['values']
+    for name, attribute in sorted(attributes.items(), key=lambda a: -a[1]['count']):
+        distinct = len(attribute['values'])
+        distinct = f"over {MAX_DISTINCT_VALUES}" if distinct > MAX_DISTINCT_VALUES else distinct
+        print(f"    {name}: in {attribute['count'] / sampled_items:.1%} of items, {distinct} distinct values")
+
+    # A full scan reads 4KB per eventually consistent half RCU, a copy or purge writes 1KB per WCU per item
+    read_units = size[0] / 4096 / 2
+    print(f"Full scan: about {read_units:.0f} read units (${read_units * args.read_price / 1e6:.2f} on-demand)")
+    print(f"Copy or purge: about {write_units[0]:.0f} write units (${write_units[0] * args.write_price / 1e6:.2f} on-demand)")
+
+    suggested = ddb_common.suggest_segments(size[0])
+    # Each sampled segment was scanned by one thread, so that's the rate of one worker
+    scanned_seconds = sum(s['seconds'] for s in samples)
+    if sampled_items and scanned_seconds:
+        rate = sampled_items / scanned_seconds * suggested
+        seconds = items[0] / rate
+        if table.get('BillingModeSummary', {}).get('BillingMode') != 'PAY_PER_REQUEST':
+            seconds = max(seconds, read_units / table['ProvisionedThroughput']['ReadCapacityUnits'])
+        print(f"Full scan with {suggested} segments: about {seconds / 60:.1f} minutes")
+    print(f"Suggested --segments: {suggested}")
+
+
+if __name__ == '__main__':
+    try:
+        args = do_args()
+        main(args)
+        exit(0)
+    except KeyboardInterrupt:
+        exit(1)
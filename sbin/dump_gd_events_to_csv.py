@@ -16,17 +16,57 @@
 import boto3
 import csv
 import argparse
+import threading
+import json
+import sqlite3
+import queue
+import time
+import math
+from botocore.exceptions import ClientError
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta, timezone
 
 parser = argparse.ArgumentParser(description="Download GuardDuty findings from all AWS regions.")
 parser.add_argument("--days", type=int, required=True, help="How many days back to look for findings")
-parser.add_argument("--outfile", type=str, required=True, help="Output CSV file name")
+parser.add_argument("--outfile", type=str, required=True, help="Output file name")
+parser.add_argument("--format", type=str, choices=["csv", "json"], default="csv", help="Output file format")
+parser.add_argument("--workers", type=int, default=8, help="Number of regions, and of get_findings batches, to fetch at the same time")
+parser.add_argument("--min-severity", type=str, help="Only findings at or above this severity, a score or one of Low, Medium, High, Critical")
+parser.add_argument("--type", type=str, action="append", dest="types", help="Only findings of this type, can be repeated")
+parser.add_argument("--org", action="store_true", help="Run as the delegated administrator and fetch each member account's findings separately, with per account totals")
+parser.add_argument("--summary", action="store_true", help="Only write finding counts by type and account per severity, from the statistics API")
+parser.add_argument("--state-db", type=str, help="SQLite file to sync findings into, only findings updated since the last sync are downloaded and the report comes from it")
 args = parser.parse_args()
+if args.summary and args.state_db:
+    print("--summary reads its counts from GuardDuty, it can't be used with --state-db")
+    exit(1)
 
 days_back = args.days
 outfile = args.outfile
 cutoff = datetime.now(timezone.utc) - timedelta(days=days_back)
 
+# Lowest score of each label, see severity_label(). GuardDuty's finding criteria only take whole numbers
+severity_scores = {"low": 1, "medium": 4, "high": 7, "critical": 9}
+
+# Filter server-side so we only download the findings we keep
+criterion = {"updatedAt": {"GreaterThanOrEqual": int(cutoff.timestamp() * 1000)}}
+min_severity = None
+if args.min_severity:
+    if args.min_severity.lower() in severity_scores:
+        min_severity = severity_scores[args.min_severity.lower()]
+    else:
+        try:
+            min_severity = float(args.min_severity)
+        except ValueError:
+            print(f"--min-severity must be a number or one of {', '.join(s.title() for s in severity_scores)}")
+            exit(1)
+    # A fractional score is rounded down for GuardDuty and the rest filtered out as findings arrive
+    criterion["severity"] = {"GreaterThanOrEqual": math.floor(min_severity)}
+if args.types:
+    criterion["type"] = {"Equals": args.types}
+# Newest first, list_findings and get_findings both return findings in this order
+sort_criteria = {"AttributeName": "updatedAt", "OrderBy": "DESC"}
+
 session = boto3.Session()
 
 # Get only enabled regions
@@ -49,8 +89,6 @@ fields = [
     "Region",
 ]
 
-results = []
-
 def severity_label(score):
     if score == 9.0:
         return "Critical"
@@ -63,52 +101,363 @@ def severity_label(score):
     else:
         return "Informational"
 
-for region in enabled_regions:
-    client = session.client("guardduty", region_name=region)
+# boto3 sessions aren't thread safe, so clients are created under a lock and each thread keeps its own
+session_lock = threading.Lock()
+thread_clients = threading.local()
+
+def get_client(region):
+    if not hasattr(thread_clients, "clients"):
+        thread_clients.clients = {}
+    if region not in thread_clients.clients:
+        with session_lock:
+            thread_clients.clients[region] = session.client("guardduty", region_name=region)
+    return thread_clients.clients[region]
+
+def fetch_batch(scope, detector_id, batch):
+    client = get_client(scope[0])
+    findings = client.get_findings(DetectorId=detector_id, FindingIds=batch, SortCriteria=sort_criteria)["Findings"]
+    if min_severity is not None:
+        findings = [finding for finding in findings if finding.get("Severity", 0) >= min_severity]
+    output_queue.put((scope, findings))
+
+def finding_row(finding):
+    score = finding.get("Severity", 0)
+    return {
+        "Finding ID": finding.get("Id", ""),
+        "Title": finding.get("Title", ""),
+        "Severity": severity_label(score),
+        "Severity Score": score,
+        "Finding Type": finding.get("Type", ""),
+        "Count of Events": finding.get("Service", {}).get("Count", 1),
+        "AWS Account ID": finding.get("AccountId", ""),
+        "Created At": finding.get("CreatedAt", ""),
+        "Updated At": finding.get("UpdatedAt", ""),
+        "Region": finding.get("Region", ""),
+    }
+
+def epoch_ms(timestamp):
+    return int(datetime.fromisoformat(timestamp.replace("Z", "+00:00")).timestamp() * 1000)
+
+def list_accounts(region, detector_id):
+    """The delegated administrator's own account and its associated members in a region"""
+    client = get_client(region)
+    accounts = [caller_account]
+    for page in client.get_paginator("list_members").paginate(DetectorId=detector_id, OnlyAssociated="true"):
+        accounts.extend(member["AccountId"] for member in page["Members"] if member["AccountId"] != caller_account)
+    return accounts
+
+def discover_region(region):
+    """Return the (region, detector_id, account_id) pieces of work in a region, account_id is None outside --org"""
+    client = get_client(region)
     try:
         detectors = client.list_detectors()["DetectorIds"]
         if not detectors:
-            continue
-        detector_id = detectors[0]
+            return []
+        if not args.org:
+            return [(region, detectors[0], None)]
+        accounts = list_accounts(region, detectors[0])
+        print(f"Found {len(accounts)} accounts in {region}")
+        return [(region, detectors[0], account_id) for account_id in accounts]
+    except ClientError as e:
+        print(f"Error processing region {region}: {e}")
+        return []
+
+def scope_criterion(account_id):
+    if account_id is None:
+        return criterion
+    return dict(criterion, accountId={"Equals": [account_id]})
+
+def watermark_key(account_id):
+    return json.dumps({k: v for k, v in scope_criterion(account_id).items() if k != "updatedAt"}, sort_keys=True)
 
+def process_findings(work):
+    """Fetch one region's findings, or with --org one account's findings in a region. Returns the count, None on error"""
+    region, detector_id, account_id = work
+    client = get_client(region)
+    scope = (region, account_id)
+    scope_criteria = {"Criterion": scope_criterion(account_id)}
+    watermark, covered_from = watermarks.get((region, watermark_key(account_id)), (None, None))
+    # The store only has what earlier syncs covered. If --days reaches back further, fetch the whole window again
+    if watermark is not None and covered_from is not None and covered_from <= criterion["updatedAt"]["GreaterThanOrEqual"]:
+        # Everything up to the watermark is already in the store. >= refetches the last few, the upsert makes that harmless
+        watermark = max(watermark, criterion["updatedAt"]["GreaterThanOrEqual"])
+        scope_criteria["Criterion"] = dict(scope_criteria["Criterion"], updatedAt={"GreaterThanOrEqual": watermark})
+    try:
         paginator = client.get_paginator("list_findings")
         finding_ids = []
+        # Findings updated after this may be missing from the listing, see sync_store()
+        listing_started[scope] = int(time.time() * 1000)
 
-        for page in paginator.paginate(DetectorId=detector_id):
+        for page in paginator.paginate(DetectorId=detector_id, FindingCriteria=scope_criteria, SortCriteria=sort_criteria):
             finding_ids.extend(page["FindingIds"])
 
-        print(f"Got Total of {len(finding_ids)} Findings in {region}")
+        if account_id is None:
+            print(f"Got Total of {len(finding_ids)} Findings in {region}")
 
-        if not finding_ids:
-            continue
+        # GuardDuty batch limit is 50
+        batches = [finding_ids[i:i+50] for i in range(0, len(finding_ids), 50)]
+        futures = [batch_pool.submit(fetch_batch, scope, detector_id, batch) for batch in batches]
+        for future in futures:
+            future.result()
+        # Tell the writer the region or account is complete, so its watermark can move
+        output_queue.put((scope, None))
+    except ClientError as e:
+        print(f"Error processing {account_id or 'findings'} in {region}: {e}")
+        return None
+    if account_id is not None:
+        with progress_lock:
+            progress["done"] += 1
+            print(f"Got {len(finding_ids)} Findings for {account_id} in {region} ({progress['done']}/{progress['total']})")
+    return len(finding_ids)
 
-        for i in range(0, len(finding_ids), 50):  # GuardDuty batch limit is 50
-            batch = finding_ids[i:i+50]
-            findings = client.get_findings(DetectorId=detector_id, FindingIds=batch)["Findings"]
+# Summaries count each severity band separately, the bands match severity_label().
+# Scores go up to 10, the edges are whole numbers like every other severity criterion.
+severity_bands = []
+for label, low in sorted(severity_scores.items(), key=lambda s: s[1]):
+    if severity_bands:
+        severity_bands[-1][2] = low
+    severity_bands.append([label.title(), low, 11])
 
-            for finding in findings:
-                updated_at = datetime.fromisoformat(finding["UpdatedAt"])
-                if updated_at < cutoff:
+# get_findings_statistics returns at most this many groups and has no paging
+STATISTICS_MAX_RESULTS = 100
+# Accounts per accountId filter when a grouping has to be split up
+STATISTICS_ACCOUNT_CHUNK = 50
+
+def finding_statistics(client, detector_id, group_by, band_criterion, accounts):
+    """One grouping of get_findings_statistics.
+
+    A full page of groups may have been cut short, so the query is split by accountId, into chunks
+    of the region's accounts and then halves of a chunk, until each piece fits. accounts() returns the
+    region's accounts and is only called when that's needed.
+    """
+    key = {"FINDING_TYPE": "GroupedByFindingType", "ACCOUNT": "GroupedByAccount"}[group_by]
+    name = {"FINDING_TYPE": "FindingType", "ACCOUNT": "AccountId"}[group_by]
+    response = client.get_findings_statistics(DetectorId=detector_id, FindingCriteria={"Criterion": band_criterion},
+                                              GroupBy=group_by, MaxResults=STATISTICS_MAX_RESULTS)
+    groups = response["FindingStatistics"].get(key, [])
+    counts = {group[name]: group["TotalFindings"] for group in groups}
+    if len(groups) < STATISTICS_MAX_RESULTS:
+        return counts
+
+    chunk = band_criterion.get("accountId", {}).get("Equals")
+    if chunk is None:
+        everyone = accounts()
+        pieces = [everyone[i:i+STATISTICS_ACCOUNT_CHUNK] for i in range(0, len(everyone), STATISTICS_ACCOUNT_CHUNK)]
+    elif len(chunk) > 1:
+        pieces = [chunk[:len(chunk) // 2], chunk[len(chunk) // 2:]]
+    else:
+        print(f"Warning: {chunk[0]} has more than {STATISTICS_MAX_RESULTS} groups by {group_by}, its counts are incomplete")
+        return counts
+    counts = {}
+    for piece in pieces:
+        for group_name, count in finding_statistics(client, detector_id, group_by, dict(band_criterion, accountId={"Equals": piece}), accounts).items():
+            counts[group_name] = counts.get(group_name, 0) + count
+    return counts
+
+def summarize_region(region):
+    """Return {"Finding Type": {type: {band: count}}, "AWS Account ID": {...}} for a region"""
+    summary = {"Finding Type": {}, "AWS Account ID": {}}
+    client = get_client(region)
+    try:
+        detectors = client.list_detectors()["DetectorIds"]
+        if not detectors:
+            return summary
+        region_accounts = []
+        def accounts():
+            if not region_accounts:
+                region_accounts.extend(list_accounts(region, detectors[0]))
+            return region_accounts
+        for label, low, high in severity_bands:
+            band_criterion = dict(criterion, severity={"GreaterThanOrEqual": low, "LessThan": high})
+            if "severity" in criterion:
+                if high <= criterion["severity"]["GreaterThanOrEqual"]:
                     continue
-                score = finding.get("Severity", 0)
-                results.append({
-                    "Finding ID": finding.get("Id", ""),
-                    "Title": finding.get("Title", ""),
-                    "Severity": severity_label(score),
-                    "Severity Score": score,
-                    "Finding Type": finding.get("Type", ""),
-                    "Count of Events": finding.get("Service", {}).get("Count", 1),
-                    "AWS Account ID": finding.get("AccountId", ""),
-                    "Created At": finding.get("CreatedAt", ""),
-                    "Updated At": finding.get("UpdatedAt", ""),
-                    "Region": region,
-                })
-    except client.exceptions.ClientError as e:
-        print(f"Error processing region {region}: {e}")
+                band_criterion["severity"]["GreaterThanOrEqual"] = max(low, criterion["severity"]["GreaterThanOrEqual"])
+            for group, group_by in (("Finding Type", "FINDING_TYPE"), ("AWS Account ID", "ACCOUNT")):
+                for name, count in finding_statistics(client, detectors[0], group_by, band_criterion, accounts).items():
+                    summary[group].setdefault(name, {})[label] = count
+    except ClientError as e:
+        print(f"Error summarizing region {region}: {e}")
+    return summary
+
+def write_summary():
+    if min_severity is not None and min_severity != criterion["severity"]["GreaterThanOrEqual"]:
+        print(f"Warning: the statistics API only takes whole scores, counting from severity {criterion['severity']['GreaterThanOrEqual']}")
+    totals = {"Finding Type": {}, "AWS Account ID": {}}
+    with ThreadPoolExecutor(max_workers=args.workers) as region_pool:
+        for summary in region_pool.map(summarize_region, enabled_regions):
+            for group, names in summary.items():
+                for name, counts in names.items():
+                    merged = totals[group].setdefault(name, {})
+                    for label, count in counts.items():
+                        merged[label] = merged.get(label, 0) + count
+
+    labels = [label for label, low, high in severity_bands]
+    with open(outfile, mode="w", newline="") as output:
+        if args.format == "json":
+            json.dump(totals, output, indent=2)
+        else:
+            writer = csv.writer(output)
+            writer.writerow(["Group", "Name"] + labels + ["Total"])
+            for group, names in totals.items():
+                for name, counts in sorted(names.items(), key=lambda n: -sum(n[1].values())):
+                    writer.writerow([group, name] + [counts.get(label, 0) for label in labels] + [sum(counts.values())])
+
+    by_severity = {label: sum(counts.get(label, 0) for counts in totals["Finding Type"].values()) for label in labels}
+    print(", ".join(f"{label}: {count}" for label, count in by_severity.items()))
+    print(f"Wrote counts for {len(totals['Finding Type'])} finding types and {len(totals['AWS Account ID'])} accounts "
+          f"from the last {days_back} days to {outfile}")
+
+if args.org or args.summary:
+    caller_account = session.client("sts").get_caller_identity()["Account"]
+
+if args.summary:
+    write_summary()
+    exit(0)
+
+# The store is keyed by finding ID, so re-downloading a finding just updates it.
+# Watermarks are kept per region and per set of filters, a sync with --type X says nothing about other types.
+# With --org each account gets its own, as an accountId filter. Each one also records the earliest
+# updatedAt its syncs have covered, so a longer --days than before isn't answered from a partial store.
+watermarks = {}
+# When each region's or account's list_findings started, epoch ms
+listing_started = {}
+WATERMARK_MARGIN_MS = 5 * 60 * 1000
+if args.state_db:
+    # Only one thread uses the connection at a time, the writer thread while fetching and this one before and after
+    db = sqlite3.connect(args.state_db, check_same_thread=False)
+    db.execute("""CREATE TABLE IF NOT EXISTS findings (
+        id TEXT PRIMARY KEY, region TEXT, account_id TEXT, type TEXT, severity REAL, updated_at INTEGER, finding TEXT)""")
+    db.execute("CREATE INDEX IF NOT EXISTS findings_updated_at ON findings (updated_at)")
+    db.execute("""CREATE TABLE IF NOT EXISTS watermarks (
+        region TEXT, criteria TEXT, updated_at INTEGER, covered_from INTEGER, PRIMARY KEY (region, criteria))""")
+    if "covered_from" not in [column[1] for column in db.execute("PRAGMA table_info(watermarks)")]:
+        # Stores from before covered_from was kept, their watermarks are ignored until the next full sync
+        db.execute("ALTER TABLE watermarks ADD COLUMN covered_from INTEGER")
+    for region, key, updated_at, covered_from in db.execute("SELECT region, criteria, updated_at, covered_from FROM watermarks"):
+        watermarks[(region, key)] = (updated_at, covered_from)
+
+def write_report(batches):
+    """Write batches of findings to the outfile as they arrive, flushing each so a crash keeps what was written"""
+    count = 0
+    with open(outfile, mode="w", newline="") as output:
+        if args.format == "json":
+            output.write("[")
+        else:
+            writer = csv.DictWriter(output, fieldnames=fields)
+            writer.writeheader()
+        for findings in batches:
+            for finding in findings:
+                if args.format == "json":
+                    output.write(("," if count else "") + "\n" + json.dumps(finding, default=str))
+                else:
+                    writer.writerow(finding_row(finding))
+                count += 1
+            output.flush()
+        if args.format == "json":
+            output.write("\n]\n")
+    return count
+
+def sync_store(batches):
+    """Upsert batches of findings as they arrive, a watermark only moves once all its region's or account's batches are in.
+
+    The finding bodies are fetched after the listing, so they can be newer than it. A finding updated
+    while the listing ran may not be in it, so the watermark never passes the time the listing started,
+    less WATERMARK_MARGIN_MS for GuardDuty's own lag.
+    """
+    newest = {}
+    synced = {}
+    for scope, findings in batches:
+        region, account_id = scope
+        if findings is None:
+            safe = listing_started[scope] - WATERMARK_MARGIN_MS
+            if scope in newest:
+                safe = min(safe, newest[scope])
+            key = watermark_key(account_id)
+            old_watermark, old_from = watermarks.get((region, key), (None, None))
+            # This sync covered the cutoff onwards and joins up with whatever the earlier ones covered
+            covered_from = criterion["updatedAt"]["GreaterThanOrEqual"]
+            if old_from is not None:
+                covered_from = min(covered_from, old_from)
+            if old_watermark is not None:
+                safe = max(safe, old_watermark)
+            with db:
+                db.execute("INSERT OR REPLACE INTO watermarks VALUES (?, ?, ?, ?)", (region, key, safe, covered_from))
+            if account_id is None:
+                print(f"Synced {synced.get(scope, 0)} findings in {region} to {args.state_db}")
+            continue
+        with db:
+            db.executemany("INSERT OR REPLACE INTO findings VALUES (?, ?, ?, ?, ?, ?, ?)", [
+                (f["Id"], region, f.get("AccountId", ""), f.get("Type", ""), f.get("Severity", 0), epoch_ms(f["UpdatedAt"]), json.dumps(f, default=str))
+                for f in findings])
+        for f in findings:
+            newest[scope] = max(newest.get(scope, 0), epoch_ms(f["UpdatedAt"]))
+        synced[scope] = synced.get(scope, 0) + len(findings)
+
+def stored_findings():
+    """The report's findings from the store, newest first, a batch at a time"""
+    query = "SELECT finding FROM findings WHERE updated_at >= ?"
+    params = [criterion["updatedAt"]["GreaterThanOrEqual"]]
+    if "severity" in criterion:
+        query += " AND severity >= ?"
+        params.append(min_severity)
+    if "type" in criterion:
+        query += f" AND type IN ({', '.join('?' for t in args.types)})"
+        params.extend(args.types)
+    cursor = db.execute(query + " ORDER BY updated_at DESC", params)
+    while True:
+        rows = cursor.fetchmany(1000)
+        if not rows:
+            break
+        yield [json.loads(finding) for (finding,) in rows]
+
+# Fetch threads hand ((region, account_id), findings) to a single writer thread, (scope, None) when a region or
+# account is complete and None when everything is. The bound keeps memory flat if the writer falls behind.
+output_queue = queue.Queue(maxsize=args.workers * 4)
+writer_result = {}
+
+def run_writer():
+    messages = iter(output_queue.get, None)
+    try:
+        if args.state_db:
+            sync_store(messages)
+        else:
+            writer_result["count"] = write_report(findings for scope, findings in messages if findings is not None)
+    except BaseException as e:
+        writer_result["error"] = e
+        # Keep draining so the fetch threads don't block on a full queue
+        for message in messages:
+            pass
+
+with ThreadPoolExecutor(max_workers=args.workers) as region_pool:
+    work = [w for region_work in region_pool.map(discover_region, enabled_regions) for w in region_work]
+progress_lock = threading.Lock()
+progress = {"done": 0, "total": len(work)}
+
+writer_thread = threading.Thread(target=run_writer)
+writer_thread.start()
+try:
+    # Regions and accounts wait on their batches, so the batches get their own pool
+    with ThreadPoolExecutor(max_workers=args.workers) as batch_pool:
+        with ThreadPoolExecutor(max_workers=args.workers) as work_pool:
+            counts = list(work_pool.map(process_findings, work))
+finally:
+    output_queue.put(None)
+    writer_thread.join()
+if "error" in writer_result:
+    raise writer_result["error"]
+
+if args.org:
+    account_totals = {}
+    for (region, detector_id, account_id), count in zip(work, counts):
+        if count is not None:
+            account_totals[account_id] = account_totals.get(account_id, 0) + count
+    for account_id, total in sorted(account_totals.items(), key=lambda a: -a[1]):
+        print(f"{account_id}: {total} findings")
 
-with open(outfile, mode="w", newline="") as csvfile:
-    writer = csv.DictWriter(csvfile, fieldnames=fields)
-    writer.writeheader()
-    writer.writerows(results)
+if args.state_db:
+    count = write_report(stored_findings())
+else:
+    count = writer_result["count"]
 
-print(f"Wrote {len(results)} findings from the last {days_back} days to {outfile}")
\ No newline at end of file
+print(f"Wrote {count} findings from the last {days_back} days to {outfile}")
@@ -5,17 +5,36 @@
 
 # import boto.dynamodb
 # import boto.dynamodb.condition as condition
-import sys, argparse
+import sys, argparse, os, threading, json
 import boto3
+from boto3.dynamodb.conditions import Key
 from botocore.exceptions import ClientError
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+# The shared DynamoDB helpers live with the other DynamoDB scripts in bin
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), '..', 'bin'))
+import ddb_common
+
+SORT_KEY_OPERATORS = ['eq', 'lt', 'lte', 'gt', 'gte', 'begins_with', 'between']
+
+# Set when the user hits Ctrl-C so segments stop after their current page
+stop_purge = threading.Event()
 
 def do_args():
 	parser = argparse.ArgumentParser()
 	parser.add_argument("--debug", help="print debugging info", action='store_true')
 	parser.add_argument("--table", help="Tablename", required=True)
-	parser.add_argument("--key_attribute", help="primary key", required=True)
-	parser.add_argument("--range", help="range", default=None)
+	parser.add_argument("--key_attribute", help="primary key (default: read from the table's key schema)")
+	parser.add_argument("--range", help="range (default: read from the table's key schema)", default=None)
+	parser.add_argument("--segments", help="Split the scan into this many parallel scan segments, or auto to size it from the table", type=ddb_common.segments_arg, default=1)
+	parser.add_argument("--workers", help="Number of segments to purge at the same time (defaults to --segments, at most 32)", type=int)
+	parser.add_argument("--partition-key-value", help="Only delete the items with this partition key value (uses query instead of scan)")
+	parser.add_argument("--sort-key-condition", help=f"With --partition-key-value, only delete items whose sort key matches OP VALUE [VALUE2]. OP is one of {', '.join(SORT_KEY_OPERATORS)}", nargs='+', metavar='OP VALUE')
+	parser.add_argument("--index", help="Query this index instead of the table with --partition-key-value")
 	parser.add_argument("--force", help="don't prompt for safety", action='store_true')
+	parser.add_argument("--recreate", help="Delete and recreate the table with the same definition instead of deleting every item", action='store_true')
+	parser.add_argument("--endpoint-url", help="DynamoDB endpoint, e.g. http://localhost:8000 for DynamoDB Local")
+	parser.add_argument("--capacity-fraction", help="Limit reads and deletes to this fraction (0-1] of the table's provisioned capacity", type=float)
 
 
 	args = parser.parse_args()
@@ -26,39 +45,261 @@ def do_args():
 	if args.key_attribute == "":
 		print("Must specify --key_attribute")
 		exit(1)
+	if args.workers is not None and args.workers < 1:
+		print("--workers must be at least 1")
+		exit(1)
+	if args.capacity_fraction is not None and not 0 < args.capacity_fraction <= 1:
+		print("--capacity-fraction must be greater than 0 and at most 1")
+		exit(1)
+	if (args.sort_key_condition or args.index) and args.partition_key_value is None:
+		print("--sort-key-condition and --index need --partition-key-value")
+		exit(1)
+	if args.partition_key_value is not None and args.segments == 'auto':
+		args.segments = 1
+	if args.partition_key_value is not None and (args.segments > 1 or args.recreate):
+		print("--partition-key-value can't be combined with --segments or --recreate")
+		exit(1)
+	if args.sort_key_condition:
+		operator, values = args.sort_key_condition[0], args.sort_key_condition[1:]
+		if operator not in SORT_KEY_OPERATORS:
+			print(f"--sort-key-condition operator must be one of {', '.join(SORT_KEY_OPERATORS)}")
+			exit(1)
+		if len(values) != (2 if operator == 'between' else 1):
+			print(f"--sort-key-condition {operator} takes {2 if operator == 'between' else 1} value(s)")
+			exit(1)
 
 	return(args)
 
+def get_client(args):
+	# boto3 sessions are not thread safe, so every segment builds its own
+	return(boto3.Session().resource('dynamodb', endpoint_url=args.endpoint_url).meta.client)
+
+def capture_table(client, table_name):
+	"""Everything needed to recreate the table: the CreateTable arguments plus the settings CreateTable can't take"""
+	table = client.describe_table(TableName=table_name)['Table']
+	if table.get('DeletionProtectionEnabled'):
+		print(f"{table_name} has deletion protection enabled, turn it off first")
+		exit(1)
+	if table.get('Replicas'):
+		print(f"{table_name} is a global table, it can't be recreated by this script")
+		exit(1)
+
+	billing_mode = table.get('BillingModeSummary', {}).get('BillingMode', 'PROVISIONED')
+	create = {
+		'TableName': table_name,
+		'KeySchema': table['KeySchema'],
+		'AttributeDefinitions': table['AttributeDefinitions'],
+		'BillingMode': billing_mode,
+	}
+	if billing_mode == 'PROVISIONED':
+		create['ProvisionedThroughput'] = {
+			'ReadCapacityUnits': table['ProvisionedThroughput']['ReadCapacityUnits'],
+			'WriteCapacityUnits': table['ProvisionedThroughput']['WriteCapacityUnits']
+		}
+	if 'OnDemandThroughput' in table:
+		create['OnDemandThroughput'] = table['OnDemandThroughput']
+
+	gsis = []
+	for index in table.get('GlobalSecondaryIndexes', []):
+		gsi = {'IndexName': index['IndexName'], 'KeySchema': index['KeySchema'], 'Projection': index['Projection']}
+		if billing_mode == 'PROVISIONED':
+			gsi['ProvisionedThroughput'] = {
+				'ReadCapacityUnits': index['ProvisionedThroughput']['ReadCapacityUnits'],
+				'WriteCapacityUnits': index['ProvisionedThroughput']['WriteCapacityUnits']
+			}
+		if 'OnDemandThroughput' in index:
+			gsi['OnDemandThroughput'] = index['OnDemandThroughput']
+		gsis.append(gsi)
+	if gsis:
+		create['GlobalSecondaryIndexes'] = gsis
+
+	lsis = [{'IndexName': i['IndexName'], 'KeySchema': i['KeySchema'], 'Projection': i['Projection']} for i in table.get('LocalSecondaryIndexes', [])]
+	if lsis:
+		create['LocalSecondaryIndexes'] = lsis
+
+	if table.get('StreamSpecification', {}).get('StreamEnabled'):
+		create['StreamSpecification'] = table['StreamSpecification']
+	sse = table.get('SSEDescription', {})
+	if sse.get('Status') in ('ENABLED', 'ENABLING') and sse.get('SSEType') == 'KMS':
+		create['SSESpecification'] = {'Enabled': True, 'SSEType': 'KMS', 'KMSMasterKeyId': sse['KMSMasterKeyArn']}
+	if 'TableClassSummary' in table:
+		create['TableClass'] = table['TableClassSummary']['TableClass']
+
+	# The rest either isn't supported everywhere (DynamoDB Local) or may not be allowed, so just warn
+	tags = []
+	try:
+		response = client.list_tags_of_resource(ResourceArn=table['TableArn'])
+		tags += response.get('Tags', [])
+		while 'NextToken' in response:
+			response = client.list_tags_of_resource(ResourceArn=table['TableArn'], NextToken=response['NextToken'])
+			tags += response.get('Tags', [])
+	except ClientError as e:
+		print(f"Unable to read tags of {table_name}: {e}")
+	if tags:
+		create['Tags'] = tags
+
+	try:
+		create['ResourcePolicy'] = client.get_resource_policy(ResourceArn=table['TableArn'])['Policy']
+	except ClientError as e:
+		if e.response['Error']['Code'] != 'PolicyNotFoundException':
+			print(f"Unable to read the resource policy of {table_name}: {e}")
+
+	ttl = None
+	try:
+		ttl_description = client.describe_time_to_live(TableName=table_name)['TimeToLiveDescription']
+		if ttl_description.get('TimeToLiveStatus') in ('ENABLED', 'ENABLING'):
+			ttl = ttl_description['AttributeName']
+	except ClientError as e:
+		print(f"Unable to read the TTL settings of {table_name}: {e}")
+
+	pitr = None
+	try:
+		pitr_description = client.describe_continuous_backups(TableName=table_name)['ContinuousBackupsDescription'].get('PointInTimeRecoveryDescription', {})
+		if pitr_description.get('PointInTimeRecoveryStatus') == 'ENABLED':
+			pitr = {'PointInTimeRecoveryEnabled': True}
+			if 'RecoveryPeriodInDays' in pitr_description:
+				pitr['RecoveryPeriodInDays'] = pitr_description['RecoveryPeriodInDays']
+	except ClientError as e:
+		print(f"Unable to read the point in time recovery settings of {table_name}: {e}")
+
+	return({'CreateTable': create, 'TimeToLiveAttribute': ttl, 'PointInTimeRecovery': pitr})
+
+def recreate_table(args, client):
+	definition = capture_table(client, args.table)
+
+	# Keep a copy of the definition in case something goes wrong after the delete
+	definition_file = f"{args.table}-definition.json"
+	with open(definition_file, 'w') as f:
+		json.dump(definition, f, indent=2, default=str)
+	print(f"Saved the definition of {args.table} to {definition_file}")
+
+	client.delete_table(TableName=args.table)
+	print(f"Deleting {args.table}")
+	client.get_waiter('table_not_exists').wait(TableName=args.table)
+
+	client.create_table(**definition['CreateTable'])
+	print(f"Creating {args.table}")
+	client.get_waiter('table_exists').wait(TableName=args.table)
+
+	if definition['TimeToLiveAttribute']:
+		client.update_time_to_live(TableName=args.table, TimeToLiveSpecification={'Enabled': True, 'AttributeName': definition['TimeToLiveAttribute']})
+	if definition['PointInTimeRecovery']:
+		client.update_continuous_backups(TableName=args.table, PointInTimeRecoverySpecification=definition['PointInTimeRecovery'])
+	print(f"Recreated {args.table}")
+
+def key_condition(args, table):
+	"""The KeyConditionExpression for --partition-key-value and --sort-key-condition on the table or --index"""
+	schema = table['KeySchema']
+	if args.index:
+		indexes = {i['IndexName']: i for i in table.get('GlobalSecondaryIndexes', []) + table.get('LocalSecondaryIndexes', [])}
+		if args.index not in indexes:
+			print(f"{args.table} has no index named {args.index}")
+			exit(1)
+		schema = indexes[args.index]['KeySchema']
+	hash_key = [k['AttributeName'] for k in schema if k['KeyType'] == 'HASH'][0]
+	range_keys = [k['AttributeName'] for k in schema if k['KeyType'] == 'RANGE']
+
+	condition = Key(hash_key).eq(ddb_common.key_value(table, hash_key, args.partition_key_value))
+	if args.sort_key_condition:
+		if not range_keys:
+			print(f"{args.index or args.table} has no sort key")
+			exit(1)
+		operator = args.sort_key_condition[0]
+		values = [ddb_common.key_value(table, range_keys[0], v) for v in args.sort_key_condition[1:]]
+		condition = condition & getattr(Key(range_keys[0]), operator)(*values)
+	return(condition)
+
+def delete_pages(args, client, operation, read_args, key_names, read_throttle, write_throttle, label):
+	"""Delete every item returned by a scan or query, page by page"""
+	count = 0
+	response = ddb_common.read_page(operation, read_throttle, **read_args)
+	while True:
+		requests = [{'DeleteRequest': {'Key': {k: item[k] for k in key_names}}} for item in response['Items']]
+		ddb_common.batch_write(client, args.table, requests, write_throttle)
+		count += len(requests)
+		if args.debug:
+			print(f"{label}: deleted {count} items")
+		if 'LastEvaluatedKey' not in response or stop_purge.is_set():
+			break
+		response = ddb_common.read_page(operation, read_throttle, ExclusiveStartKey=response['LastEvaluatedKey'], **read_args)
+	return(count)
+
+def purge_segment(args, segment, key_names, read_throttle, write_throttle):
+	client = get_client(args)
+
+	# Only fetch the key attributes, they're all a delete needs
+	scan_args = {'TableName': args.table}
+	scan_args.update(ddb_common.build_expressions(projection=key_names, raw=False))
+	if args.segments > 1:
+		scan_args['Segment'] = segment
+		scan_args['TotalSegments'] = args.segments
+	return(delete_pages(args, client, client.scan, scan_args, key_names, read_throttle, write_throttle, f"Segment {segment}"))
+
+def purge_query(args, table, key_names, read_throttle, write_throttle):
+	client = get_client(args)
+
+	# Indexes always project the table's key attributes, so they're all we fetch either way
+	query_args = {'TableName': args.table}
+	if args.index:
+		query_args['IndexName'] = args.index
+	query_args.update(ddb_common.build_expressions(key_condition=key_condition(args, table), projection=key_names, raw=False))
+	return(delete_pages(args, client, client.query, query_args, key_names, read_throttle, write_throttle, "Query"))
+
 def main(args):
 	# Connect to the table.
-	dynamodb = boto3.resource('dynamodb')
-	my_table = dynamodb.Table(args.table)
+	client = get_client(args)
+	ddb_common.resolve_segments(args, client, args.table)
+	table = client.describe_table(TableName=args.table)['Table']
+	key_names = [k['AttributeName'] for k in sorted(table['KeySchema'], key=lambda k: k['KeyType'] != 'HASH')]
+	if args.key_attribute is not None:
+		key_names = [args.key_attribute] + ([args.range] if args.range is not None else [])
+	if args.debug:
+		print(f"Key attributes: {key_names}")
 
 	if not args.force:
 		# Print a warning
-		print('About to delete all rows from table {}!!!'.format(args.table))
+		if args.partition_key_value is not None:
+			print('About to delete all rows with partition key {} from table {}!!!'.format(args.partition_key_value, args.index or args.table))
+		else:
+			print('About to delete all rows from table {}!!!'.format(args.table))
 		print('Are you sure? (type "YES" to continue)')
 		response = input().upper()
 		if response != 'YES':
 			print('OK, not deleting anything!')
 			quit()
 
-	batch = my_table.batch_writer()
-	response = my_table.scan()
-	while 'LastEvaluatedKey' in response :
-		for item in response['Items']:
-			if args.range is None:
-				batch.delete_item(Key={args.key_attribute: item[args.key_attribute] } )
-			else:
-				batch.delete_item(Key={args.key_attribute: item[args.key_attribute], args.range: item[args.range] } )
-		response = my_table.scan(ExclusiveStartKey=response['LastEvaluatedKey'])
-	for item in response['Items']:
-		if args.range is None:
-			batch.delete_item(Key={args.key_attribute: item[args.key_attribute] } )
-		else:
-			batch.delete_item(Key={args.key_attribute: item[args.key_attribute], args.range: item[args.range] } )
+	if args.recreate:
+		recreate_table(args, client)
+		return
+
+	read_throttle, write_throttle = ddb_common.make_throttles(client, args.table, args.capacity_fraction)
+
+	if args.partition_key_value is not None:
+		total = purge_query(args, table, key_names, read_throttle, write_throttle)
+		print(f"Deleted {total} items from {args.table}")
+		print(read_throttle.summary())
+		print(write_throttle.summary())
+		return
+
+	total = 0
+	executor = ThreadPoolExecutor(max_workers=args.workers)
+	try:
+		futures = {executor.submit(purge_segment, args, segment, key_names, read_throttle, write_throttle): segment for segment in range(args.segments)}
+		for future in as_completed(futures):
+			count = future.result()
+			total += count
+			if args.segments > 1:
+				print(f"Segment {futures[future]} of {args.segments} finished: {count} items")
+	except BaseException:
+		print("Stopping, waiting for in-flight deletes to finish")
+		stop_purge.set()
+		executor.shutdown(wait=True, cancel_futures=True)
+		raise
+	executor.shutdown()
 
-	batch.__exit__(None, None, None)
+	print(f"Deleted {total} items from {args.table}")
+	print(read_throttle.summary())
+	print(write_throttle.summary())
 
 
 